@@ -0,0 +1,375 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import pickle
+import random
+import statistics
+import threading
+import time
+import zoneinfo
+from datetime import datetime, timedelta
+
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+from pyhafas.types.fptf import Journey, Leg, Station, StationBoardLeg, Stopover
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import main
+
+
+class FakeHafasClient:
+    # Stand-in for HafasClient which replays recorded responses and invents a consistent
+    # network for everything else. Every call sleeps for the configured latency.
+    def __init__(self, recording=None, latency=0.0, jitter=0.0, stations=200, stopovers=10, seed=1):
+        self.responses = {}
+        if recording is not None:
+            with open(recording, "rb") as file:
+                self.responses = pickle.load(file)
+        self.latency = latency
+        self.jitter = jitter
+        self.stopovers = stopovers
+        self.calls = {}
+        self.random = random.Random(seed)
+        self.stations = [Station(str(8000000 + i), "Station %i" % i, 47.5 + self.random.random() * 7, 6 + self.random.random() * 9) for i in range(stations)]
+        self.stations_by_id = {station.id: station for station in self.stations}
+        self.stations_by_name = {station.name.lower(): station for station in self.stations}
+
+    def _call(self, method, key):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        return self.responses.get((method,) + key)
+
+    def _leg(self, origin, destination, date, name):
+        # The stopovers between two stations are derived from their ids, so the same query always gets the same leg
+        rng = random.Random("%s-%s" % (origin.id, destination.id))
+        stopovers = [origin] + rng.sample([station for station in self.stations if station not in (origin, destination)], self.stopovers) + [destination]
+        duration = timedelta(minutes=rng.randint(20, 120))
+        id = "1|%s|%s|%s|%s" % (origin.id, destination.id, date.strftime("%d%m%y%H%M"), name.replace(" ", ""))
+        return Leg(id, origin, destination, date, date + duration, name=name, stopovers=[Stopover(stop) for stop in stopovers])
+
+    def locations(self, term):
+        response = self._call("locations", (term,))
+        if response is not None:
+            return response
+        return [self.stations_by_name[term.lower()]] if term.lower() in self.stations_by_name else []
+
+    def journeys(self, origin, destination, date, **kwargs):
+        response = self._call("journeys", (str(origin), str(destination), date.isoformat()))
+        if response is not None:
+            return response
+        origin, destination = self.stations_by_id[str(origin)], self.stations_by_id[str(destination)]
+        leg = self._leg(origin, destination, date, "ICE %i" % (int(origin.id) % 1000))
+        return [Journey("journey-%s" % leg.id, legs=[leg])]
+
+    def departures(self, station, date, **kwargs):
+        response = self._call("departures", (str(station), date.isoformat()))
+        if response is not None:
+            return response
+        return [StationBoardLeg("board-%s-%i" % (station, i), "RE %i" % i, "Station %i" % i, self.stations_by_id[str(station)], date, False) for i in range(5)]
+
+    def trip(self, id):
+        response = self._call("trip", (id,))
+        if response is not None:
+            return response
+        _, origin, destination, date, name = id.split("|")
+        date = datetime.strptime(date, "%d%m%y%H%M").replace(tzinfo=zoneinfo.ZoneInfo(key="Europe/Berlin"))
+        return self._run(self._leg(self.stations_by_id[origin], self.stations_by_id[destination], date, name))
+
+    def _run(self, leg):
+        # Like HAFAS, a trip is the whole run of the train, which starts before the origin of the leg and ends after its
+        # destination. The delay grows by a minute at every station, so it differs between the ends of the run and the leg.
+        rng = random.Random(leg.id)
+        stops = [stopover.stop for stopover in leg.stopovers]
+        others = rng.sample([station for station in self.stations if station not in stops], 4)
+        before, after = others[:2], others[2:]
+        stopovers = ([Stopover(stop, departure=leg.departure - timedelta(minutes=30 * (2 - i))) for i, stop in enumerate(before)]
+                     + [Stopover(stop) for stop in stops]
+                     + [Stopover(stop, arrival=leg.arrival + timedelta(minutes=30 * (i + 1))) for i, stop in enumerate(after)])
+        stopovers[2].departure, stopovers[-3].arrival = leg.departure, leg.arrival
+        for i, stopover in enumerate(stopovers):
+            stopover.departureDelay = timedelta(minutes=i) if stopover.departure is not None else None
+            stopover.arrivalDelay = timedelta(minutes=i) if stopover.arrival is not None else None
+        return Leg(leg.id, stopovers[0].stop, stopovers[-1].stop, stopovers[0].departure, stopovers[-1].arrival, name=leg.name,
+                   departure_delay=stopovers[0].departureDelay, arrival_delay=stopovers[-1].arrivalDelay, stopovers=stopovers)
+
+
+class RecordingHafasClient:
+    # Wraps a real HafasClient and stores its responses for FakeHafasClient
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.responses = {}
+
+    def _record(self, key, response):
+        self.responses[key] = response
+        with open(self.path, "wb") as file:
+            pickle.dump(self.responses, file)
+        return response
+
+    def locations(self, term):
+        return self._record(("locations", term), self.client.locations(term))
+
+    def journeys(self, origin, destination, date, **kwargs):
+        return self._record(("journeys", str(origin), str(destination), date.isoformat()), self.client.journeys(origin=origin, destination=destination, date=date, **kwargs))
+
+    def departures(self, station, date, **kwargs):
+        return self._record(("departures", str(station), date.isoformat()), self.client.departures(station=station, date=date, **kwargs))
+
+    def trip(self, id):
+        return self._record(("trip", id), self.client.trip(id))
+
+
+class FakeHafasHandler(tornado.web.RequestHandler):
+    def initialize(self, server):
+        self.server = server
+
+    async def post(self):
+        delay = self.server.latency + self.server.random.uniform(0, self.server.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.server.random.random() < self.server.error_rate:
+            self.set_status(503)
+            return
+        request = json.loads(self.request.body)["svcReqL"][0]
+        self.write(self.server.respond(request["meth"], request["req"]))
+
+
+class FakeHafasServer:
+    # Serves a FakeHafasClient as HAFAS mgate endpoint, so requests go through pyhafas and HTTP like in production.
+    # error_rate of the requests are answered with 503. The server runs in its own thread and event loop.
+    def __init__(self, hafas, latency=0.0, jitter=0.0, error_rate=0.0, seed=1):
+        self.hafas = hafas
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.url = None
+
+    def start(self):
+        ready = threading.Event()
+
+        def serve():
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            # The 503 answers would otherwise be logged one by one
+            logging.getLogger("tornado.access").disabled = True
+            sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+            tornado.httpserver.HTTPServer(tornado.web.Application([(r"/mgate.exe", FakeHafasHandler, {"server": self})])).add_sockets(sockets)
+            self.url = "http://127.0.0.1:%i/mgate.exe" % sockets[0].getsockname()[1]
+            ready.set()
+            asyncio.get_event_loop().run_forever()
+
+        threading.Thread(target=serve, daemon=True).start()
+        ready.wait()
+        return self.url
+
+    def _location(self, common, station):
+        lid = "A=1@O=%s@X=%i@Y=%i@L=%s@" % (station.name, round(station.longitude * 1000000), round(station.latitude * 1000000), station.id)
+        locations = [location["lid"] for location in common["locL"]]
+        if lid in locations:
+            return locations.index(lid)
+        common["locL"].append({"lid": lid, "name": station.name, "crd": {"x": round(station.longitude * 1000000), "y": round(station.latitude * 1000000)}})
+        return len(common["locL"]) - 1
+
+    def _product(self, common, name):
+        common["prodL"].append({"name": name})
+        return len(common["prodL"]) - 1
+
+    def _time(self, dt, day):
+        # Times after midnight are prefixed with the number of days after the date of the journey
+        return "%02i%s" % ((dt.date() - day).days, dt.strftime("%H%M%S"))
+
+    def _journey(self, common, leg, day):
+        stops = [{"locX": self._location(common, stopover.stop)} for stopover in leg.stopovers]
+        for stop, stopover in zip(stops, leg.stopovers):
+            for prefix, time, delay in (("d", stopover.departure, stopover.departureDelay), ("a", stopover.arrival, stopover.arrivalDelay)):
+                if time is not None:
+                    stop[prefix + "TimeS"] = self._time(time, day)
+                if time is not None and delay is not None:
+                    stop[prefix + "TimeR"] = self._time(time + delay, day)
+        stops[0].setdefault("dTimeS", self._time(leg.departure, day))
+        stops[-1].setdefault("aTimeS", self._time(leg.arrival, day))
+        return {"jid": leg.id, "prodX": self._product(common, leg.name), "date": day.strftime("%Y%m%d"), "dirTxt": leg.destination.name, "stopL": stops}
+
+    def respond(self, method, request):
+        common = {"locL": [], "prodL": []}
+        lid = lambda location: dict(part.split("=", 1) for part in location["lid"].split("@") if part)["L"]
+        if method == "LocMatch":
+            locations = self.hafas.locations(request["input"]["loc"]["name"])
+            result = {"match": {"locL": [common["locL"][self._location(common, station)] for station in locations]}}
+        elif method == "TripSearch":
+            date = datetime.strptime(request["outDate"] + request["outTime"], "%Y%m%d%H%M%S").replace(tzinfo=zoneinfo.ZoneInfo(key="Europe/Berlin"))
+            connections = []
+            for journey in self.hafas.journeys(lid(request["depLocL"][0]), lid(request["arrLocL"][0]), date):
+                day = journey.legs[0].departure.date()
+                duration = journey.legs[-1].arrival - journey.legs[0].departure
+                connections.append({"ctxRecon": journey.id, "date": day.strftime("%Y%m%d"),
+                                    "dur": "%02i%02i%02i" % (duration.seconds // 3600 + duration.days * 24, duration.seconds // 60 % 60, duration.seconds % 60),
+                                    "secL": [{"type": "JNY", "jny": self._journey(common, leg, day),
+                                              "dep": {"locX": self._location(common, leg.origin), "dTimeS": self._time(leg.departure, day)},
+                                              "arr": {"locX": self._location(common, leg.destination), "aTimeS": self._time(leg.arrival, day)}}
+                                             for leg in journey.legs]})
+            result = {"outConL": connections}
+        elif method == "JourneyDetails":
+            leg = self.hafas.trip(request["jid"])
+            result = {"journey": self._journey(common, leg, leg.departure.date())}
+        elif method == "StationBoard":
+            date = datetime.strptime(request["date"] + request["time"], "%Y%m%d%H%M%S").replace(tzinfo=zoneinfo.ZoneInfo(key="Europe/Berlin"))
+            result = {"jnyL": [{"jid": board.id, "prodX": self._product(common, board.name), "dirTxt": board.direction, "date": board.dateTime.strftime("%Y%m%d"),
+                                "stbStop": {"locX": self._location(common, board.station), "dTimeS": self._time(board.dateTime, board.dateTime.date())}}
+                               for board in self.hafas.departures(lid(request["stbLoc"]), date)]}
+        else:
+            return {"err": "OK", "svcResL": [{"err": "FAIL", "errTxt": "Unknown method %s" % method}]}
+        result["common"] = common
+        return {"err": "OK", "svcResL": [{"err": "OK", "res": result}]}
+
+
+class FakeUser:
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeMessage:
+    def __init__(self, id, text, reply_to_message=None):
+        self.id = id
+        self.text = text
+        self.reply_to_message = reply_to_message
+        self.replies = []
+
+    async def reply_text(self, text, reply_to_message_id=None, **kwargs):
+        self.replies.append(text)
+        return FakeMessage(self.id + 1, text)
+
+    async def edit_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeUpdate:
+    # Just enough of telegram.Update for the handlers
+    def __init__(self, user_id, message):
+        self.effective_user = FakeUser(user_id)
+        self.effective_chat = FakeUser(user_id)
+        self.message = message
+        self.effective_message = message
+
+
+class FakeContext:
+    def __init__(self, args=None):
+        self.args = args or []
+        self.user_data = {}
+
+
+def build_message(hafas, date, legs, rng):
+    lines = ["Benchmark", date.strftime("%d.%m.%Y")]
+    departure = date.replace(hour=6)
+    origin = rng.choice(hafas.stations)
+    for i in range(legs):
+        destination = rng.choice([station for station in hafas.stations if station is not origin])
+        leg = hafas._leg(origin, destination, departure.replace(tzinfo=zoneinfo.ZoneInfo(key="Europe/Berlin")), "")
+        lines += ["", "ICE %i" % (int(origin.id) % 1000), "-",
+                  "ab %s %s, Gl. 1" % (leg.departure.strftime("%H:%M"), origin.name),
+                  "an %s %s, Gl. 2" % (leg.arrival.strftime("%H:%M"), destination.name)]
+        # The next leg starts where this one ended
+        origin, departure = destination, (leg.arrival + timedelta(minutes=10)).replace(tzinfo=None)
+    return "\n".join(lines)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def reset_database():
+    async with main.engine.begin() as connection:
+        await connection.run_sync(main.Base.metadata.drop_all)
+    await main.migrate(main.engine)
+    main.station_name_cache.clear()
+    main.station_index.clear()
+    if main.hafas.cache is not None:
+        main.hafas.cache.clear()
+
+
+async def simulate_user(hafas, user_id, messages, legs, latencies, rng):
+    context = FakeContext()
+    for i in range(messages):
+        date = datetime(2023, 1, 1) + timedelta(days=user_id * messages + i)
+        message = FakeMessage(1000 + i * 10, build_message(hafas, date, legs, rng))
+        started = time.perf_counter()
+        await main.toDatabase(FakeUpdate(user_id, message), context)
+        latencies["toDatabase"].append(time.perf_counter() - started)
+        if not message.replies or not message.replies[-1].startswith("✅"):
+            latencies["errors"].append(message.replies[-1] if message.replies else "no reply")
+
+        context.args = ["%i,%02i" % (rng.randint(5, 120), rng.randint(0, 99))]
+        started = time.perf_counter()
+        await main.price(FakeUpdate(user_id, FakeMessage(message.id + 5, "/price", reply_to_message=message)), context)
+        latencies["price"].append(time.perf_counter() - started)
+        context.args = []
+
+
+async def run_level(hafas, users, messages, legs, reset, verbose):
+    if reset:
+        await reset_database()
+    hafas.calls = {}
+    latencies = {"toDatabase": [], "price": [], "errors": []}
+    started = time.perf_counter()
+    # The handlers log every message, which would bury the results
+    with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO()):
+        await asyncio.gather(*[simulate_user(hafas, 1000 + user, messages, legs, latencies, random.Random(user)) for user in range(users)])
+    elapsed = time.perf_counter() - started
+
+    print("%i concurrent user(s), %i message(s) with %i leg(s) each, %.2f s" % (users, users * messages, legs, elapsed))
+    for handler in ("toDatabase", "price"):
+        values = latencies[handler]
+        print("  %-10s p50 %7.1f ms  p95 %7.1f ms  p99 %7.1f ms  mean %7.1f ms  %7.1f msg/s" % (
+            handler, percentile(values, 50) * 1000, percentile(values, 95) * 1000, percentile(values, 99) * 1000,
+            statistics.mean(values) * 1000, len(values) / elapsed))
+    print("  HAFAS calls %s, errors %i" % (", ".join("%s %i" % call for call in sorted(hafas.calls.items())), len(latencies["errors"])))
+    for error in latencies["errors"][:3]:
+        print("    %s" % error)
+
+
+async def run(args):
+    # The bot's own PG_* database is never used, the tables are dropped before every run
+    main.engine = create_async_engine(args.database_url)
+    main.Session.configure(bind=main.engine)
+
+    if args.hafas_server:
+        # The server adds the latency, the client behind it answers at once
+        hafas = FakeHafasClient(recording=args.recording, stations=args.stations, stopovers=args.stopovers)
+        server = FakeHafasServer(hafas, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+        main.client.profile.baseUrl = server.start()
+        main.hafas.client = main.client
+    else:
+        hafas = FakeHafasClient(recording=args.recording, latency=args.latency, jitter=args.jitter, stations=args.stations, stopovers=args.stopovers)
+        main.hafas.client = hafas
+    main.hafas.limiter = main.TokenBucket(args.rate, max(1, int(args.rate))) if args.rate else None
+
+    for users in args.users:
+        await run_level(hafas, users, args.messages, args.legs, not args.keep_data, args.verbose)
+    await main.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the latency of the bot handlers against a fake HAFAS and a local database. "
+                                                 "The database is emptied before every run, never point it to production.")
+    parser.add_argument("--database-url", required=True, help="SQLAlchemy URL of the benchmark database, all its tables are dropped")
+    parser.add_argument("--users", type=lambda value: [int(users) for users in value.split(",")], default=[1, 10, 100], help="Comma separated numbers of concurrent users")
+    parser.add_argument("--messages", type=int, default=5, help="Journey messages per user")
+    parser.add_argument("--legs", type=int, default=3, help="Legs per journey message")
+    parser.add_argument("--stopovers", type=int, default=10, help="Stopovers per leg")
+    parser.add_argument("--stations", type=int, default=200, help="Stations of the fake network")
+    parser.add_argument("--latency", type=float, default=0.1, help="Artificial latency of every HAFAS call in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Random additional latency in seconds")
+    parser.add_argument("--recording", help="Pickled responses recorded with RecordingHafasClient")
+    parser.add_argument("--hafas-server", action="store_true", help="Serve the fake HAFAS over HTTP, so the pooled, retrying HAFAS client of the bot is used")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests the fake HAFAS server answers with 503")
+    parser.add_argument("--rate", type=float, help="Limit of HAFAS requests per second, unlimited by default")
+    parser.add_argument("--keep-data", action="store_true", help="Do not empty the database between runs")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the handlers")
+    asyncio.get_event_loop().run_until_complete(run(parser.parse_args()))
@@ -1,35 +1,397 @@
+import argparse
+import asyncio
+import contextlib
+import contextvars
+import csv
+import functools
+import hashlib
+import html
+import json
+import math
 import os
+import random
 import re
+import sys
+import tempfile
+import time
 import zoneinfo
-from datetime import datetime
-
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date as datetime_date, timedelta
+
+import numpy as np
+import requests
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Float, ForeignKey, DateTime, Date, Index, select, delete as sql_delete, update as sql_update, func, text, event, or_, union_all, tuple_, cast
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, joinedload, selectinload, make_transient_to_detached, aliased
+
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
 
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
-import psycopg2
+import tornado.web
 
-from telegram import Update
-from telegram.ext import filters, MessageHandler, ApplicationBuilder, CommandHandler, ContextTypes
+from telegram import Update, Message, Chat
+from telegram.ext import filters, MessageHandler, ApplicationBuilder, CommandHandler, ContextTypes, BasePersistence, PersistenceInput
 
 from pyhafas import HafasClient
 from pyhafas.profile import DBProfile
+from pyhafas.profile.base.mappings.error_codes import BaseErrorCodesMapping
+from pyhafas.types.hafas_response import HafasResponse
 from sqlalchemy.sql import ClauseElement
 
-engine = create_engine('postgresql+psycopg2://%s:%s@%s:%s/%s' % (os.getenv("PG_USER"), os.getenv("PG_PASS"), os.getenv("PG_HOST"), os.getenv("PG_PORT", "5432"), os.getenv("PG_DB")))
-Session = sessionmaker(bind=engine)
+from prometheus_client import Counter, Histogram, start_http_server
+
+engine = create_async_engine('postgresql+asyncpg://%s:%s@%s:%s/%s' % (os.getenv("PG_USER"), os.getenv("PG_PASS"), os.getenv("PG_HOST"), os.getenv("PG_PORT", "5432"), os.getenv("PG_DB")),
+                       pool_size=int(os.getenv("PG_POOL_SIZE", "5")),
+                       max_overflow=int(os.getenv("PG_MAX_OVERFLOW", "10")),
+                       pool_recycle=int(os.getenv("PG_POOL_RECYCLE", "1800")),
+                       pool_pre_ping=os.getenv("PG_POOL_PRE_PING", "true").lower() == "true",
+                       connect_args={"server_settings": {"statement_timeout": os.getenv("PG_STATEMENT_TIMEOUT", "30000")}})
+# Objects stay usable after commit, lazy refreshes are not possible with asyncio
+Session = async_sessionmaker(bind=engine, expire_on_commit=False)
 Session.configure(bind=engine)
 Base = declarative_base()
 
-client = HafasClient(DBProfile(), debug=False)
+ADMIN_USER_IDS = [user_id.strip() for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()]
+
+HANDLER_SECONDS = Histogram("rhtb_handler_seconds", "Time spent handling an update", ["handler"])
+STAGE_SECONDS = Histogram("rhtb_stage_seconds", "Time spent in a stage of a handler", ["stage"])
+HAFAS_REQUESTS = Counter("rhtb_hafas_requests_total", "Requests sent to HAFAS", ["method"])
+HAFAS_FAILURES = Counter("rhtb_hafas_failures_total", "HAFAS requests which timed out or failed with a temporary error", ["method"])
+HAFAS_REJECTIONS = Counter("rhtb_hafas_rejections_total", "HAFAS requests not sent because the circuit breaker was open")
+HAFAS_FALLBACKS = Counter("rhtb_hafas_fallbacks_total", "Legs searched on the departure boards because the journey search found none")
+CACHE_REQUESTS = Counter("rhtb_cache_requests_total", "Cache lookups", ["cache", "result"])
+DB_QUERIES = Counter("rhtb_db_queries_total", "Statements sent to the database")
+DELAY_REFRESHES = Counter("rhtb_delay_refreshes_total", "Segments whose delays were refreshed", ["result"])
+QUEUED_UPDATES = Counter("rhtb_queued_updates_total", "Updates received by the webhook")
+QUEUE_WAIT_SECONDS = Histogram("rhtb_queue_wait_seconds", "Time updates waited in the queue until a worker claimed them")
+DB_QUERIES_PER_UPDATE = Histogram("rhtb_db_queries_per_update", "Statements sent to the database while handling an update", ["handler"],
+                                  buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+# The trace of the update that is handled, tasks started by the handler share it
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    # Timings and counters of a single handled update
+    def __init__(self, handler):
+        self.handler = handler
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+
+    def add(self, stage, seconds):
+        calls, total = self.stages.get(stage, (0, 0))
+        self.stages[stage] = (calls + 1, total + seconds)
+
+    def count(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def summary(self):
+        stages = ", ".join("%s %ix %i ms" % (stage, calls, total * 1000) for stage, (calls, total) in self.stages.items())
+        counters = ", ".join("%s %i" % counter for counter in self.counters.items())
+        return "%s took %i ms: %s" % (self.handler, (time.perf_counter() - self.started) * 1000, "; ".join(part for part in (stages, counters) if part) or "-")
+
+
+def count(counter, amount=1):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.count(counter, amount)
+
+
+def observe(stage, seconds):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+@contextlib.contextmanager
+def span(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - started)
+
+
+# Locks of the users with updates in progress and the number of updates holding or waiting for them
+user_locks = {}
+
+
+@contextlib.asynccontextmanager
+async def user_lock(user_id):
+    # Updates are handled concurrently, but the updates of one user in the order they arrived,
+    # so a reply to a journey or an edit never overtakes the message that saves the journey
+    if user_id is None:
+        yield
+        return
+    lock, waiting = user_locks.get(user_id, (asyncio.Lock(), 0))
+    user_locks[user_id] = (lock, waiting + 1)
+    try:
+        async with lock:
+            yield
+    finally:
+        lock, waiting = user_locks[user_id]
+        if waiting == 1:
+            del user_locks[user_id]
+        else:
+            user_locks[user_id] = (lock, waiting - 1)
+
+
+def traced(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with user_lock(update.effective_user.id if update.effective_user else None):
+            return await handle(update, context)
+
+    async def handle(update, context):
+        trace = Trace(handler.__name__)
+        token = current_trace.set(trace)
+        try:
+            return await handler(update, context)
+        finally:
+            current_trace.reset(token)
+            HANDLER_SECONDS.labels(trace.handler).observe(time.perf_counter() - trace.started)
+            DB_QUERIES_PER_UPDATE.labels(trace.handler).observe(trace.stages.get("db", (0, 0))[0])
+            print(trace.summary())
+    return wrapper
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    DB_QUERIES.inc()
+    observe("db", time.perf_counter() - connection.info["query_started"].pop())
+
+
+class LRUCache:
+    # Least recently used cache with a time to live per entry
+    def __init__(self, maxsize=1024, ttl=None, name="cache"):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+            self.entries.move_to_end(key)
+            self.hits += 1
+            CACHE_REQUESTS.labels(self.name, "hit").inc()
+            count("%s cache hits" % self.name)
+            return entry[1]
+        if entry is not None:
+            del self.entries[key]
+        self.misses += 1
+        CACHE_REQUESTS.labels(self.name, "miss").inc()
+        count("%s cache misses" % self.name)
+        return None
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl if self.ttl else None, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        return self.entries.pop(key, None) is not None
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return "%i entries, %i hits, %i misses" % (len(self.entries), self.hits, self.misses)
+
+
+class TokenBucket:
+    # Allows rate acquisitions per second on average and bursts of up to burst at once
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HafasUnavailableError(Exception):
+    # HAFAS did not answer in time or the circuit breaker is open, the request may succeed later
+    pass
+
+
+class PooledDBProfile(DBProfile):
+    # DBProfile opens a new connection for every request and waits for the answer forever. This one keeps
+    # the connections of a shared session alive and fails on timeouts and HTTP errors like 429 or 503.
+    def __init__(self, url=None, timeout=None, pool_size=10):
+        super().__init__()
+        if url:
+            self.baseUrl = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, body):
+        data = {'svcReqL': [body]}
+        data.update(self.requestBody)
+        data = json.dumps(data)
+        response = self.session.post(self.url_formatter(data), data=data, timeout=self.timeout,
+                                     headers={'User-Agent': self.userAgent, 'Content-Type': 'application/json'})
+        response.raise_for_status()
+        return HafasResponse(response, BaseErrorCodesMapping)
+
+
+def is_temporary_hafas_error(e):
+    # Errors HAFAS itself answered with, like an unknown trip, would fail again
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and (e.response.status_code == 429 or e.response.status_code >= 500)
+    return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+
+class CircuitBreaker:
+    # Opens after threshold temporary errors in a row, so requests fail at once instead of waiting for
+    # timeouts. After reset_timeout seconds requests are let through again, the first error opens it again.
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+
+    def is_open(self):
+        return self.opened is not None and time.monotonic() - self.opened < self.reset_timeout
+
+    def succeeded(self):
+        if self.opened is not None:
+            print("HAFAS is available again, closing circuit")
+        self.failures = 0
+        self.opened = None
+
+    def failed(self):
+        self.failures += 1
+        if self.opened is not None or self.failures >= self.threshold:
+            if not self.is_open():
+                print("HAFAS failed %i times in a row, opening circuit for %i s" % (self.failures, self.reset_timeout))
+            self.opened = time.monotonic()
+
+
+def get_hafas_kwargs_key(kwargs):
+    # Other arguments like via or max_changes change the response, values like station lists are not hashable
+    return tuple(sorted((name, str(value)) for name, value in kwargs.items()))
+
+
+class AsyncHafasClient:
+    # pyhafas is blocking, so every request is handed to a bounded thread pool.
+    # The pool size caps the number of in-flight HAFAS requests, the limiter their rate.
+    # All requests only read, so temporary errors are retried.
+    def __init__(self, client, max_concurrency=8, cache=None, limiter=None, breaker=None, retries=0, backoff=0.5):
+        self.client = client
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="hafas")
+        self.cache = cache
+        self.limiter = limiter
+        self.breaker = breaker
+        self.retries = retries
+        self.backoff = backoff
+
+    async def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            if self.breaker is not None and self.breaker.is_open():
+                HAFAS_REJECTIONS.inc()
+                count("hafas rejections")
+                raise HafasUnavailableError("HAFAS is unavailable at the moment!")
+            if self.limiter is not None:
+                with span("hafas.limiter"):
+                    await self.limiter.acquire()
+            HAFAS_REQUESTS.labels(method.__name__).inc()
+            try:
+                with span("hafas.%s" % method.__name__):
+                    response = await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+            except Exception as e:
+                if not is_temporary_hafas_error(e):
+                    if self.breaker is not None:
+                        self.breaker.succeeded()
+                    raise
+                HAFAS_FAILURES.labels(method.__name__).inc()
+                count("hafas failures")
+                if self.breaker is not None:
+                    self.breaker.failed()
+                if attempt == self.retries:
+                    raise HafasUnavailableError("HAFAS did not answer! %s" % type(e).__name__) from e
+                # Full jitter, so requests which failed together are not retried together
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            else:
+                if self.breaker is not None:
+                    self.breaker.succeeded()
+                return response
+
+    async def _cached(self, key, method, *args, **kwargs):
+        if self.cache is None:
+            return await self._run(method, *args, **kwargs)
+        response = self.cache.get(key)
+        if response is None:
+            response = await self._run(method, *args, **kwargs)
+            self.cache.put(key, response)
+        return response
+
+    async def locations(self, term):
+        return await self._run(self.client.locations, term)
+
+    async def journeys(self, origin, destination, date, products={}, max_journeys=-1, **kwargs):
+        key = ("journeys", str(origin), str(destination), date.isoformat(), tuple(sorted(products.items())), max_journeys, get_hafas_kwargs_key(kwargs))
+        return await self._cached(key, self.client.journeys, origin=origin, destination=destination, date=date, products=products, max_journeys=max_journeys, **kwargs)
+
+    async def departures(self, station, date, products={}, max_trips=-1, duration=-1, **kwargs):
+        key = ("departures", str(station), None, date.isoformat(), tuple(sorted(products.items())), max_trips, duration, get_hafas_kwargs_key(kwargs))
+        return await self._cached(key, self.client.departures, station=station, date=date, products=products, max_trips=max_trips, duration=duration, **kwargs)
+
+    async def trip(self, id, refresh=False):
+        # refresh skips the cache to get the current realtime data, the response replaces the cached one
+        if refresh and self.cache is not None:
+            self.cache.invalidate(("trip", id))
+        return await self._cached(("trip", id), self.client.trip, id)
+
+
+client = HafasClient(PooledDBProfile(url=os.getenv("HAFAS_URL"),
+                                     timeout=(float(os.getenv("HAFAS_CONNECT_TIMEOUT", "5")), float(os.getenv("HAFAS_TIMEOUT", "15"))),
+                                     pool_size=int(os.getenv("HAFAS_MAX_CONCURRENCY", "8"))), debug=False)
+hafas = AsyncHafasClient(client, max_concurrency=int(os.getenv("HAFAS_MAX_CONCURRENCY", "8")),
+                         cache=LRUCache(maxsize=int(os.getenv("HAFAS_CACHE_SIZE", "1024")), ttl=int(os.getenv("HAFAS_CACHE_TTL", "3600")), name="hafas"),
+                         limiter=TokenBucket(float(os.getenv("HAFAS_RATE", "10")), int(os.getenv("HAFAS_BURST", "10"))) if float(os.getenv("HAFAS_RATE", "10")) > 0 else None,
+                         breaker=CircuitBreaker(int(os.getenv("HAFAS_BREAKER_THRESHOLD", "5")), int(os.getenv("HAFAS_BREAKER_TIMEOUT", "30"))),
+                         retries=int(os.getenv("HAFAS_RETRIES", "2")),
+                         backoff=float(os.getenv("HAFAS_RETRY_BACKOFF", "0.5")))
+station_name_cache = LRUCache(maxsize=int(os.getenv("STATION_CACHE_SIZE", "4096")), ttl=int(os.getenv("STATION_CACHE_TTL", "86400")), name="station")
+# Rankings are shared by all users, so every group chat asking within the time to live gets the same result
+leaderboard_cache = LRUCache(maxsize=int(os.getenv("LEADERBOARD_CACHE_SIZE", "256")), ttl=int(os.getenv("LEADERBOARD_CACHE_TTL", "60")), name="leaderboard")
 
 
 class Stopover(Base):
     __tablename__ = 'stopover'
+    __table_args__ = (Index('ix_stopover_segment_id', 'segment_id'),)
     station_id = Column(Integer, ForeignKey('station.id'), primary_key=True)
     segment_id = Column(Integer, ForeignKey('segment.id'), primary_key=True)
+    # Position of the station on the segment, starting with 0 at the origin
+    sequence = Column(Integer)
 
 
 class Station(Base):
@@ -43,14 +405,50 @@ class Station(Base):
     segments = relationship("Segment", secondary=Stopover.__tablename__, back_populates="stopovers")
 
 
+class StationName(Base):
+    __tablename__ = "stationname"
+    name = Column(String(100), primary_key=True)
+    station_id = Column(Integer, ForeignKey('station.id'), nullable=False)
+    station = relationship("Station")
+
+
+class Edge(Base):
+    # The track between two consecutive stations, shared by all segments passing it.
+    # The station ids are ordered, so both directions are the same edge.
+    __tablename__ = 'edge'
+    __table_args__ = (Index('ix_edge_station1_id_station2_id', 'station1_id', 'station2_id', unique=True),)
+    id = Column(Integer, primary_key=True)
+    station1_id = Column(Integer, ForeignKey('station.id'), nullable=False)
+    station1 = relationship("Station", foreign_keys=[station1_id])
+    station2_id = Column(Integer, ForeignKey('station.id'), nullable=False)
+    station2 = relationship("Station", foreign_keys=[station2_id])
+    distance = Column(Float, nullable=False)
+
+
+class SegmentEdge(Base):
+    __tablename__ = 'segmentedge'
+    __table_args__ = (Index('ix_segmentedge_edge_id', 'edge_id'),)
+    segment_id = Column(Integer, ForeignKey('segment.id'), primary_key=True)
+    edge_id = Column(Integer, ForeignKey('edge.id'), primary_key=True)
+
+
+class BlockedStationName(Base):
+    # Normalized names admins excluded from the station index, they are always looked up at HAFAS
+    __tablename__ = "blockedstationname"
+    key = Column(String(100), primary_key=True)
+
+
 class JourneySegment(Base):
     __tablename__ = 'journeysegment'
+    __table_args__ = (Index('ix_journeysegment_segment_id', 'segment_id'),)
     journey_id = Column(Integer, ForeignKey('journey.id'), primary_key=True)
     segment_id = Column(Integer, ForeignKey('segment.id'), primary_key=True)
 
 
 class Segment(Base):
     __tablename__ = "segment"
+    __table_args__ = (Index('ix_segment_origin_id_destination_id_departurescheduledtime', 'origin_id', 'destination_id', 'departureScheduledTime'),
+                      Index('ix_segment_departurescheduledtime', 'departureScheduledTime'))
     id = Column(Integer, primary_key=True)
     segment_id = Column(String(60), unique=True)
     trainName = Column(String(60))
@@ -63,6 +461,9 @@ class Segment(Base):
     departureDelay = Column(Integer)
     departureScheduledTime = Column(DateTime, default=None)
     departureTime = Column(DateTime, default=None)
+    distance = Column(Float, default=None)
+    delayUpdatedTime = Column(DateTime, default=None)
+    delayLockedUntil = Column(DateTime(timezone=True))
 
     origin_id = Column(Integer, ForeignKey('station.id'))
     origin = relationship("Station", foreign_keys=[origin_id])
@@ -70,11 +471,13 @@ class Segment(Base):
     destination = relationship("Station", foreign_keys=[destination_id])
 
     stopovers = relationship("Station", secondary=Stopover.__tablename__, back_populates="segments")
+    edges = relationship("Edge", secondary=SegmentEdge.__tablename__)
     journeys = relationship("Journey", secondary=JourneySegment.__tablename__, back_populates="segments")
 
 
 class Category(Base):
     __tablename__ = 'category'
+    __table_args__ = (Index('ix_category_category', 'category', unique=True),)
     id = Column(Integer, primary_key=True)
     category = Column(String(50))
     color = Column(String(7), default=None)
@@ -84,6 +487,7 @@ class Category(Base):
 
 class Purpose(Base):
     __tablename__ = 'purpose'
+    __table_args__ = (Index('ix_purpose_purpose', 'purpose', unique=True),)
     id = Column(Integer, primary_key=True)
     purpose = Column(String(50))
     color = Column(String(7), default=None)
@@ -93,6 +497,9 @@ class Purpose(Base):
 
 class UserJourney(Base):
     __tablename__ = 'userjourney'
+    __table_args__ = (Index('ix_userjourney_user_id_message_id', 'user_id', 'message_id'),
+                      Index('ix_userjourney_journey_id', 'journey_id'),
+                      Index('ix_userjourney_fingerprint', 'fingerprint'))
     user_id = Column(Integer, ForeignKey('user.id'), primary_key=True)
     user = relationship("User", foreign_keys=[user_id])
     journey_id = Column(Integer, ForeignKey('journey.id'), primary_key=True)
@@ -100,6 +507,7 @@ class UserJourney(Base):
 
     message_id = Column(Integer, nullable=False)
     text = Column(String(), default=None)
+    fingerprint = Column(String(40), default=None)
     price = Column(Integer, default=None)
 
     category_id = Column(Integer, ForeignKey('category.id'))
@@ -110,8 +518,10 @@ class UserJourney(Base):
 
 class Journey(Base):
     __tablename__ = 'journey'
+    __table_args__ = (Index('ix_journey_fingerprint', 'fingerprint'),)
     id = Column(Integer, primary_key=True)
     journey_id = Column(String(), nullable=True, unique=True)
+    fingerprint = Column(String(40), default=None)
 
     segments = relationship("Segment", secondary=JourneySegment.__tablename__, back_populates="journeys")
     users = relationship("UserJourney", back_populates="journey")
@@ -126,8 +536,146 @@ class User(Base):
     journeys = relationship("UserJourney", back_populates="user")
 
 
-def get_or_create(session, model, defaults=None, **kwargs):
-    instance = session.query(model).filter_by(**kwargs).one_or_none()
+class UserStatistic(Base):
+    # Aggregates of all journeys of a user per month, kept up to date whenever a journey changes.
+    # dimension is one of total, category, purpose, station, train or edge, key is the name or edge id within it.
+    __tablename__ = 'userstatistic'
+    __table_args__ = (Index('ix_userstatistic_dimension_month', 'dimension', 'month'),)
+    user_id = Column(Integer, ForeignKey('user.id'), primary_key=True)
+    month = Column(Date, primary_key=True)
+    dimension = Column(String(20), primary_key=True)
+    key = Column(String(100), primary_key=True)
+    trips = Column(Integer, nullable=False, default=0)
+    distance = Column(Float, nullable=False, default=0)
+    duration = Column(Integer, nullable=False, default=0)
+    delay = Column(Integer, nullable=False, default=0)
+    delays = Column(Integer, nullable=False, default=0)
+    price = Column(Integer, nullable=False, default=0)
+
+
+class QueuedUpdate(Base):
+    # Updates received by the webhook until a worker has handled them. id is the update_id of Telegram,
+    # key the user the update belongs to, whose updates are handled one after another.
+    __tablename__ = 'queuedupdate'
+    __table_args__ = (Index('ix_queuedupdate_key_id', 'key', 'id'),)
+    id = Column(BigInteger, primary_key=True, autoincrement=False)
+    key = Column(BigInteger)
+    data = Column(Text, nullable=False)
+    created = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    locked_until = Column(DateTime(timezone=True))
+    attempts = Column(Integer, nullable=False, default=0)
+
+
+class PendingJourney(Base):
+    # Journey messages received while HAFAS was unavailable, saved by retryPendingJourneys once it is back
+    __tablename__ = 'pendingjourney'
+    user_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    message_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    chat_id = Column(BigInteger, nullable=False)
+    text = Column(Text, nullable=False)
+    created = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    locked_until = Column(DateTime(timezone=True))
+
+
+class UserData(Base):
+    # context.user_data of the workers, so a user can be served by any of them
+    __tablename__ = 'userdata'
+    user_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    data = Column(Text, nullable=False)
+
+
+class DatabasePersistence(BasePersistence):
+    # Only user_data is stored. It is read again before every update and written after it by the worker.
+    def __init__(self):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False))
+
+    async def get_user_data(self):
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        async with Session() as session:
+            userData = await session.get(UserData, user_id)
+        user_data.clear()
+        if userData is not None:
+            user_data.update(json.loads(userData.data))
+
+    async def update_user_data(self, user_id, data):
+        async with Session() as session:
+            if data:
+                statement = insert(UserData).values(user_id=user_id, data=json.dumps(data))
+                await session.execute(statement.on_conflict_do_update(index_elements=[UserData.user_id], set_={"data": statement.excluded.data}))
+            else:
+                await session.execute(sql_delete(UserData).where(UserData.user_id == user_id))
+            await session.commit()
+
+    async def drop_user_data(self, user_id):
+        await self.update_user_data(user_id, {})
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        pass
+
+
+# Changes to existing tables, create_all does not alter them
+MIGRATIONS = [
+    "ALTER TABLE segment ADD COLUMN IF NOT EXISTS distance FLOAT",
+    'ALTER TABLE segment ADD COLUMN IF NOT EXISTS "delayUpdatedTime" TIMESTAMP WITHOUT TIME ZONE',
+    'ALTER TABLE segment ADD COLUMN IF NOT EXISTS "delayLockedUntil" TIMESTAMP WITH TIME ZONE',
+    "ALTER TABLE journey ADD COLUMN IF NOT EXISTS fingerprint VARCHAR(40)",
+    "ALTER TABLE userjourney ADD COLUMN IF NOT EXISTS fingerprint VARCHAR(40)",
+    "ALTER TABLE stopover ADD COLUMN IF NOT EXISTS sequence INTEGER",
+]
+
+
+def create_indexes(connection):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+async def migrate(engine):
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+        for migration in MIGRATIONS:
+            await connection.execute(text(migration))
+        # create_all only creates missing tables, so indexes added to existing tables are created here
+        await connection.run_sync(create_indexes)
+
+
+async def get_or_create(session, model, defaults=None, **kwargs):
+    instance = (await session.execute(select(model).filter_by(**kwargs))).scalar_one_or_none()
     if instance:
         return instance
     else:
@@ -135,40 +683,246 @@ def get_or_create(session, model, defaults=None, **kwargs):
         params.update(defaults or {})
         instance = model(**params)
         try:
-            session.add(instance)
-            session.commit()
-        except Exception:
-            session.rollback()
-            instance = session.query(model).filter_by(**kwargs).one()
+            # A savepoint keeps the surrounding transaction alive, if another update created the row meanwhile
+            async with session.begin_nested():
+                session.add(instance)
+        except IntegrityError:
+            instance = (await session.execute(select(model).filter_by(**kwargs))).scalar_one()
             return instance
         else:
             return instance
 
 
-def get_station_by_name(session, name):
-    locations = client.locations(name)
-    best_location = locations[0]
-    return get_or_create(session, Station,
-                         {"eva": best_location.id,
-                          "name": best_location.name,
-                          "longitude": best_location.longitude,
-                          "latitude": best_location.latitude},
-                         eva=best_location.id)
+async def get_or_create_stations_by_locations(session, locations):
+    locations = {int(location.id): location for location in locations}
+    stations = {station.eva: station for station in await session.scalars(select(Station).where(Station.eva.in_(locations)))}
 
+    missing = sorted(eva for eva in locations if eva not in stations)
+    if missing:
+        # Sorted, so concurrent inserts of overlapping stations lock them in the same order
+        inserted = await session.scalars(insert(Station)
+                                   .values([{"eva": eva,
+                                             "name": locations[eva].name,
+                                             "longitude": locations[eva].longitude,
+                                             "latitude": locations[eva].latitude} for eva in missing])
+                                   .on_conflict_do_nothing(index_elements=[Station.eva])
+                                   .returning(Station))
+        stations.update({station.eva: station for station in inserted})
 
-def get_journey_or_create_by_journey_id(session, journey_id, segments):
-    return get_or_create(session, Journey, {"segments": segments}, journey_id=journey_id)
+        # Stations inserted by another update in the meantime are not returned
+        conflicted = [eva for eva in missing if eva not in stations]
+        if conflicted:
+            stations.update({station.eva: station for station in await session.scalars(select(Station).where(Station.eva.in_(conflicted)))})
+        for eva in missing:
+            station_index.add(stations[eva])
 
+    return stations
+
+
+async def gather_or_cancel(*aws):
+    # Like asyncio.gather, but the remaining lookups are cancelled as soon as one of them fails
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+async def find_location_by_name(name):
+    locations = await hafas.locations(name)
+    if len(locations) == 0:
+        raise Exception("Could not find station %s!" % name)
+    return locations[0]
+
+
+def normalize_station_name(name):
+    return " ".join(name.split()).lower()
 
-def get_user_or_create_by_user_id(session, user_id):
-    user_id = str(user_id)
-    return get_or_create(session, User, {"user_id": user_id, "username": user_id}, user_id=user_id)
 
+def station_to_record(station):
+    return {"id": station.id, "eva": station.eva, "name": station.name, "latitude": station.latitude, "longitude": station.longitude}
 
-def get_segment_or_create_by_origin_destination_departuretime_arrivaltime(session, origin, destination, departureScheduledTime, arrivalScheduledTime, trainName=None):
-    journeys = (client.journeys(
-        origin=origin.eva,
-        destination=destination.eva,
+
+async def station_from_record(session, record):
+    # Attaches the cached station to the session without querying it
+    station = Station(**record)
+    make_transient_to_detached(station)
+    return await session.merge(station, load=False)
+
+
+STATION_NAME_ABBREVIATIONS = {"hauptbahnhof": "hbf", "bahnhof": "bf", "strasse": "str", "sankt": "st", "main": "m"}
+
+
+def get_station_index_key(name):
+    # Case, umlauts, punctuation and common abbreviations do not matter in the index
+    name = name.casefold().replace("ß", "ss").replace("ä", "ae").replace("ö", "oe").replace("ü", "ue")
+    return " ".join(STATION_NAME_ABBREVIATIONS.get(token, token) for token in re.sub(r"[\W_]+", " ", name).split())
+
+
+class StationRecord:
+    # Compact copy of a Station row
+    __slots__ = ("id", "eva", "name", "latitude", "longitude", "key")
+
+    def __init__(self, id, eva, name, latitude, longitude):
+        self.id = id
+        self.eva = eva
+        self.name = name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.key = get_station_index_key(name or "")
+
+    def to_record(self):
+        return {"id": self.id, "eva": self.eva, "name": self.name, "latitude": self.latitude, "longitude": self.longitude}
+
+
+class StationIndex:
+    # All known stations by their normalized name.
+    # Similar names are often different stations, like Essen and Essenbach or Berlin Westkreuz and Berlin Ostkreuz,
+    # so only exact names are matched, everything else is left to HAFAS.
+    def __init__(self):
+        self.records = {}
+        self.ids = set()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, station):
+        if station.id in self.ids:
+            return
+        record = StationRecord(station.id, station.eva, station.name, station.latitude, station.longitude)
+        self.ids.add(record.id)
+        if record.key in self.records:
+            return
+        self.records[record.key] = record
+
+    def clear(self):
+        self.records.clear()
+        self.ids.clear()
+
+    def find(self, name):
+        key = get_station_index_key(name)
+        if not key:
+            return None
+        record = self.records.get(key)
+        CACHE_REQUESTS.labels("station_index", "miss" if record is None else "hit").inc()
+        count("station index %s" % ("misses" if record is None else "hits"))
+        return record
+
+    def stats(self):
+        return "%i stations, %i names" % (len(self.ids), len(self.records))
+
+
+station_index = StationIndex()
+
+
+async def load_station_index():
+    async with Session() as session:
+        for station in (await session.execute(select(Station.id, Station.eva, Station.name, Station.latitude, Station.longitude))).all():
+            station_index.add(station)
+    print("Loaded %s into the station index" % station_index.stats())
+
+
+async def get_known_stations_by_names(session, names):
+    stations = {}
+    missing = []
+    for name in dict.fromkeys(names):
+        record = station_name_cache.get(normalize_station_name(name))
+        if record is not None:
+            stations[name] = await station_from_record(session, record)
+        else:
+            missing.append(name)
+
+    if missing:
+        known = {stationName.name: stationName.station for stationName in
+                 await session.scalars(select(StationName).options(joinedload(StationName.station))
+                                       .where(StationName.name.in_([normalize_station_name(name) for name in missing])))}
+        for name in missing:
+            station = known.get(normalize_station_name(name))
+            if station is not None:
+                station_name_cache.put(normalize_station_name(name), station_to_record(station))
+                stations[name] = station
+
+    # Names never seen before are looked up in the stations known from all segments before asking HAFAS
+    records = {name: station_index.find(name) for name in missing if name not in stations}
+    records = {name: record for name, record in records.items() if record is not None}
+    if records:
+        blocked = set(await session.scalars(select(BlockedStationName.key).where(BlockedStationName.key.in_([get_station_index_key(name) for name in records]))))
+        for name, record in records.items():
+            if get_station_index_key(name) not in blocked:
+                station_name_cache.put(normalize_station_name(name), record.to_record())
+                stations[name] = await station_from_record(session, record.to_record())
+
+    return stations
+
+
+async def get_or_create_stations_by_names_locations(session, locations):
+    # locations maps the names as written in messages to the locations found by HAFAS
+    created = await get_or_create_stations_by_locations(session, locations.values())
+    stations = {name: created[int(location.id)] for name, location in locations.items()}
+    await session.execute(insert(StationName)
+                          .values(sorted(({"name": normalize_station_name(name), "station_id": station.id} for name, station in stations.items()), key=lambda row: row["name"]))
+                          .on_conflict_do_nothing(index_elements=[StationName.name]))
+    for name, station in stations.items():
+        station_name_cache.put(normalize_station_name(name), station_to_record(station))
+    return stations
+
+
+async def get_stations_by_names(session, names):
+    stations = await get_known_stations_by_names(session, names)
+
+    missing = [name for name in dict.fromkeys(names) if name not in stations]
+    if missing:
+        locations = await gather_or_cancel(*[find_location_by_name(name) for name in missing])
+        stations.update(await get_or_create_stations_by_names_locations(session, dict(zip(missing, locations))))
+
+    return stations
+
+
+async def get_journey_or_create_by_journey_id(session, journey_id, segments):
+    return await get_or_create(session, Journey, {"segments": segments}, journey_id=journey_id)
+
+
+async def get_user_or_create_by_user_id(session, user_id):
+    user_id = str(user_id)
+    return await get_or_create(session, User, {"user_id": user_id, "username": user_id}, user_id=user_id)
+
+
+async def find_leg_by_departures(origin_eva, destination_eva, departureScheduledTime, arrivalScheduledTime):
+    # A single board of all products, limited to the minutes around the departure, so trains are not
+    # crowded out by buses and trams and the board never has to be fetched a second time
+    departures = await hafas.departures(station=origin_eva,
+                                        date=departureScheduledTime,
+                                        max_trips=40,
+                                        duration=int(os.getenv("HAFAS_BOARD_DURATION", "2")),
+                                        products={})
+    stationBoardLegs = {sbl.id: sbl for sbl in departures if str(sbl.station.id) == str(origin_eva) and sbl.dateTime == departureScheduledTime}
+
+    tasks = [asyncio.ensure_future(hafas.trip(id)) for id in stationBoardLegs]
+    try:
+        for task in asyncio.as_completed(tasks):
+            try:
+                leg = await task
+            except HafasUnavailableError:
+                raise
+            except Exception as e:
+                print("Could not fetch trip. e.args: %s" % e.args)
+                continue
+            if str(leg.destination.id) == str(destination_eva) and leg.arrival == arrivalScheduledTime:
+                return leg
+    finally:
+        # The first matching trip wins, the remaining requests are not needed anymore
+        for task in tasks:
+            task.cancel()
+
+    raise Exception("Could not find suitable connection through departures.")
+
+
+async def find_leg_by_origin_destination_departuretime_arrivaltime(origin_eva, destination_eva, departureScheduledTime, arrivalScheduledTime, trainName=None):
+    journeys = (await hafas.journeys(
+        origin=origin_eva,
+        destination=destination_eva,
         date=departureScheduledTime,
         min_change_time=0,
         max_changes=0
@@ -194,29 +948,10 @@ def get_segment_or_create_by_origin_destination_departuretime_arrivaltime(sessio
             leg = j.legs[0]
         else:
             print("Received too less journeys. Try to determine by departures.")
-            stationBoardLeg = None
-            for max_trips, product in [(25, {'suburban': False, 'bus': False, 'ferry': False, 'subway': False, 'tram': False, 'taxi': False}), (40,{})]:
-                departuers = client.departures(
-                                    station=origin.eva,
-                                    date=departureScheduledTime,
-                                    max_trips=max_trips,
-                                    products=product
-                                )
-                stationBoardLegs = [sbl for sbl in departuers if str(sbl.station.id) == str(origin.eva) and sbl.dateTime == departureScheduledTime]
-                for _stationBoardLeg in stationBoardLegs:
-                    _leg = client.trip(_stationBoardLeg.id)
-                    if str(_leg.destination.id) == str(destination.eva) and _leg.arrival == arrivalScheduledTime:
-                        stationBoardLeg = _leg
-                        break
-
-                if stationBoardLeg is None:
-                    continue
-                break
-
-            if stationBoardLeg is None:
-                raise Exception("Could not find suitable connection through departures.")
-
-            leg = stationBoardLeg
+            HAFAS_FALLBACKS.inc()
+            count("fallbacks")
+            with span("fallback"):
+                leg = await find_leg_by_departures(origin_eva, destination_eva, departureScheduledTime, arrivalScheduledTime)
     else:
         j = journeys[0]
         leg = j.legs[0]
@@ -224,41 +959,200 @@ def get_segment_or_create_by_origin_destination_departuretime_arrivaltime(sessio
     if leg is None:
         raise Exception("Leg is not set.")
 
-    return get_or_create(session, Segment,
+    return leg
+
+
+def haversine(latitude1, longitude1, latitude2, longitude2):
+    # Great-circle distance in metres
+    latitude1, longitude1, latitude2, longitude2 = map(math.radians, (latitude1, longitude1, latitude2, longitude2))
+    a = math.sin((latitude2 - latitude1) / 2) ** 2 + math.cos(latitude1) * math.cos(latitude2) * math.sin((longitude2 - longitude1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+
+def get_leg_distance(leg):
+    stops = [leg.origin] + [stopover.stop for stopover in leg.stopovers or []] + [leg.destination]
+    stops = [stop for stop in stops if stop.latitude is not None and stop.longitude is not None]
+    return sum(haversine(a.latitude, a.longitude, b.latitude, b.longitude) for a, b in zip(stops, stops[1:]))
+
+
+def get_segment_distance(segment):
+    # Segments stored before distances were recorded fall back to the direct distance
+    if segment.distance is not None:
+        return segment.distance
+    if None in (segment.origin.latitude, segment.origin.longitude, segment.destination.latitude, segment.destination.longitude):
+        return 0
+    return haversine(segment.origin.latitude, segment.origin.longitude, segment.destination.latitude, segment.destination.longitude)
+
+
+def haversine_many(latitudes1, longitudes1, latitudes2, longitudes2):
+    # haversine for arrays of coordinates at once
+    latitudes1, longitudes1, latitudes2, longitudes2 = (np.radians(np.asarray(values, dtype=float)) for values in (latitudes1, longitudes1, latitudes2, longitudes2))
+    a = np.sin((latitudes2 - latitudes1) / 2) ** 2 + np.cos(latitudes1) * np.cos(latitudes2) * np.sin((longitudes2 - longitudes1) / 2) ** 2
+    return 2 * 6371000 * np.arcsin(np.sqrt(a))
+
+
+def get_leg_stops(leg):
+    # Origin, stopovers and destination in the order of the leg, HAFAS usually lists the origin and destination as stopovers too
+    stops = {}
+    for stop in [leg.origin] + [stopover.stop for stopover in leg.stopovers or []] + [leg.destination]:
+        stops.setdefault(stop.id, stop)
+    return list(stops.values())
+
+
+def get_route_pairs(route):
+    # Pairs of consecutive stations, stations without coordinates are skipped
+    route = [station for station in route if station.latitude is not None and station.longitude is not None]
+    return [(a, b) for a, b in zip(route, route[1:]) if a.id != b.id]
+
+
+def get_edge_key(a, b):
+    return min(a.id, b.id), max(a.id, b.id)
+
+
+def get_segment_route(segment, stopovers):
+    # stopovers are (sequence, station) tuples, those stored before the sequence was kept are ordered by their distance from the origin
+    if all(sequence is not None for sequence, station in stopovers):
+        stations = [station for sequence, station in sorted(stopovers, key=lambda stopover: stopover[0])]
+    elif segment.origin.latitude is None or segment.origin.longitude is None:
+        stations = []
+    else:
+        stations = sorted((station for sequence, station in stopovers if station.latitude is not None and station.longitude is not None),
+                          key=lambda station: haversine(segment.origin.latitude, segment.origin.longitude, station.latitude, station.longitude))
+    return list(dict.fromkeys([segment.origin] + stations + [segment.destination]))
+
+
+async def get_or_create_edges(session, routes):
+    pairs = {get_edge_key(a, b): (a, b) for route in routes for a, b in get_route_pairs(route)}
+    if not pairs:
+        return {}
+    edges = {(edge.station1_id, edge.station2_id): edge for edge in await session.scalars(select(Edge).where(tuple_(Edge.station1_id, Edge.station2_id).in_(list(pairs))))}
+
+    missing = sorted(pair for pair in pairs if pair not in edges)
+    if missing:
+        distances = haversine_many([pairs[pair][0].latitude for pair in missing], [pairs[pair][0].longitude for pair in missing],
+                                   [pairs[pair][1].latitude for pair in missing], [pairs[pair][1].longitude for pair in missing])
+        # Sorted like the stations, so concurrent inserts of overlapping edges lock them in the same order
+        inserted = await session.scalars(insert(Edge)
+                                         .values([{"station1_id": station1_id, "station2_id": station2_id, "distance": float(distance)}
+                                                  for (station1_id, station2_id), distance in zip(missing, distances)])
+                                         .on_conflict_do_nothing(index_elements=[Edge.station1_id, Edge.station2_id])
+                                         .returning(Edge))
+        edges.update({(edge.station1_id, edge.station2_id): edge for edge in inserted})
+
+        conflicted = [pair for pair in missing if pair not in edges]
+        if conflicted:
+            edges.update({(edge.station1_id, edge.station2_id): edge for edge in await session.scalars(select(Edge).where(tuple_(Edge.station1_id, Edge.station2_id).in_(conflicted)))})
+
+    return edges
+
+
+async def get_or_create_stations_edges_by_legs(session, legs):
+    # Stations and edges are shared by all segments, so they are created for all legs at once before the segments
+    stations = await get_or_create_stations_by_locations(session, [stop for leg in legs for stop in get_leg_stops(leg)])
+    edges = await get_or_create_edges(session, [[stations[int(stop.id)] for stop in get_leg_stops(leg)] for leg in legs])
+    return stations, edges
+
+
+def to_database_time(dt):
+    # Times are stored as Berlin wall-clock time in columns without time zone
+    if dt is None:
+        return None
+    return dt.astimezone(zoneinfo.ZoneInfo(key="Europe/Berlin")).replace(tzinfo=None)
+
+
+def get_delays(departure, departureDelay, arrival, arrivalDelay):
+    # Delays are stored in seconds, departureTime and arrivalTime are the real times
+    delays = {}
+    for prefix, scheduled, delay in (("departure", departure, departureDelay), ("arrival", arrival, arrivalDelay)):
+        delays[prefix + "Delay"] = int(delay.total_seconds()) if delay is not None else None
+        delays[prefix + "Time"] = to_database_time(scheduled + delay) if scheduled is not None and delay is not None else None
+    return delays
+
+
+def get_leg_delays(leg):
+    return get_delays(leg.departure, leg.departureDelay, leg.arrival, leg.arrivalDelay)
+
+
+def get_segment_delays(segment, leg):
+    # A trip covers the whole run of the train, the segment only the part between its origin and destination.
+    # Returns None if the trip does not pass both of them.
+    stops = [str(stopover.stop.id) for stopover in leg.stopovers or []]
+    if str(segment.origin.eva) not in stops:
+        return None
+    origin = stops.index(str(segment.origin.eva))
+    if str(segment.destination.eva) not in stops[origin + 1:]:
+        return None
+    departure, arrival = leg.stopovers[origin], leg.stopovers[stops.index(str(segment.destination.eva), origin + 1)]
+    return get_delays(departure.departure, departure.departureDelay, arrival.arrival, arrival.arrivalDelay)
+
+
+async def get_segment_by_origin_destination_departuretime_arrivaltime(session, origin, destination, departureScheduledTime, arrivalScheduledTime, trainName=None):
+    # Segments which are already known do not need any HAFAS request
+    segments = (await session.scalars(select(Segment).filter_by(origin_id=origin.id,
+                                                                destination_id=destination.id,
+                                                                departureScheduledTime=to_database_time(departureScheduledTime),
+                                                                arrivalScheduledTime=to_database_time(arrivalScheduledTime)))).all()
+    if len(segments) > 1:
+        segments = [s for s in segments if s.trainName == trainName]
+    if len(segments) == 1:
+        return segments[0]
+    return None
+
+
+async def get_segment_or_create_by_leg(session, leg, stations=None, edges=None):
+    # stations and edges are passed in when they were already created for a batch of legs
+    segment = (await session.execute(select(Segment).filter_by(segment_id=leg.id))).scalar_one_or_none()
+    if segment is not None:
+        return segment
+
+    stops = get_leg_stops(leg)
+    if stations is None:
+        stations = await get_or_create_stations_by_locations(session, stops)
+    route = [stations[int(stop.id)] for stop in stops]
+    if edges is None:
+        edges = await get_or_create_edges(session, [route])
+    segment = await get_or_create(session, Segment,
                          {"segment_id": leg.id,
                           "trainName": leg.name,
-                          "origin": get_or_create(session, Station, {"eva": leg.origin.id, "name": leg.origin.name,
-                                                      "latitude": leg.origin.latitude,
-                                                      "longitude": leg.origin.longitude}, eva=leg.origin.id),
-                          "destination": get_or_create(session, Station,
-                                        {"eva": leg.destination.id, "name": leg.destination.name,
-                                         "latitude": leg.destination.latitude,
-                                         "longitude": leg.destination.longitude}, eva=leg.destination.id),
-                          "stopovers": [
-                             get_or_create(session, Station, {"eva": stopover.stop.id, "name": stopover.stop.name,
-                                                              "latitude": stopover.stop.latitude,
-                                                              "longitude": stopover.stop.longitude},
-                                           eva=stopover.stop.id) for stopover in leg.stopovers]},
+                          "distance": get_leg_distance(leg),
+                          "departureScheduledTime": to_database_time(leg.departure),
+                          "arrivalScheduledTime": to_database_time(leg.arrival),
+                          "delayUpdatedTime": to_database_time(datetime.now(zoneinfo.ZoneInfo(key="Europe/Berlin"))),
+                          **get_leg_delays(leg),
+                          "origin": stations[int(leg.origin.id)],
+                          "destination": stations[int(leg.destination.id)]},
                          segment_id=leg.id)
 
+    # Rows which another update created for the same segment in the meantime are left alone
+    await session.execute(insert(Stopover)
+                          .values([{"station_id": station.id, "segment_id": segment.id, "sequence": sequence} for sequence, station in enumerate(route)])
+                          .on_conflict_do_nothing())
+    edge_ids = sorted({edges[get_edge_key(a, b)].id for a, b in get_route_pairs(route)})
+    if edge_ids:
+        await session.execute(insert(SegmentEdge)
+                              .values([{"segment_id": segment.id, "edge_id": edge_id} for edge_id in edge_ids])
+                              .on_conflict_do_nothing())
+    return segment
+
 
-def get_userjourney_by_user_journey(session, user, journey, message_id, text):
-    return get_or_create(session, UserJourney, {"user": user,
+async def get_userjourney_by_user_journey(session, user, journey, message_id, text, fingerprint=None):
+    return await get_or_create(session, UserJourney, {"user": user,
                                                 "journey": journey,
                                                 "message_id": message_id,
-                                                "text": text},
+                                                "text": text,
+                                                "fingerprint": fingerprint},
                          user=user,
                          journey=journey)
 
 
-def get_category_or_create_by_category(session, category, color=None):
-    return get_or_create(session, Category, {"category": category,
+async def get_category_or_create_by_category(session, category, color=None):
+    return await get_or_create(session, Category, {"category": category,
                                              "color": color},
                          category=category)
 
 
-def get_purpose_or_create_by_purpose(session, purpose, color=None):
-    return get_or_create(session, Purpose, {"purpose": purpose,
+async def get_purpose_or_create_by_purpose(session, purpose, color=None):
+    return await get_or_create(session, Purpose, {"purpose": purpose,
                                              "color": color},
                          purpose=purpose)
 
@@ -275,65 +1169,827 @@ def split_on_new_lines(s):
     return re.split(blank_line_regex, s.strip())
 
 
-async def toDatabase(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    print("Triggered toDatabase command by %i" % update.effective_user.id)
-    loading_message = await update.message.reply_text("\u23F3 Loading...", reply_to_message_id=update.message.id)
-    input = update.message.text
-    with Session() as session:
-        try:
-
-            k = split_on_empty_lines(input)
+def parse_journey_message(text):
+    k = split_on_empty_lines(text)
 
-            if len(k) <= 1:
-                raise Exception("Journey is missing or too short!")
+    if len(k) <= 1:
+        raise Exception("Journey is missing or too short!")
 
-            l = split_on_new_lines(k[0])
+    l = split_on_new_lines(k[0])
 
-            if not re.match("([0-9]+)\.([0-9]+)\.([0-9]+)", l[1]):
-                raise Exception("Date is in wrong format or missing!")
+    if len(l) < 2 or not re.match("([0-9]+)\.([0-9]+)\.([0-9]+)", l[1]):
+        raise Exception("Date is in wrong format or missing!")
 
-            date = datetime.strptime(l[1], '%d.%m.%Y')
+    date = datetime.strptime(l[1], '%d.%m.%Y')
 
-            segments = []
-            for s in k[1:]:
-                l = split_on_new_lines(s)
-                if len(l) < 4:
-                    raise Exception("Segment lines are in wrong format or missing!")
+    legs = []
+    for s in k[1:]:
+        l = split_on_new_lines(s)
+        if len(l) < 4:
+            raise Exception("Segment lines are in wrong format or missing!")
 
-                trainName = l[0]
+        trainName = l[0]
 
-                d = l[2].split(",")[0].split(" ")
-                departureScheduledTime = datetime.combine(date, datetime.strptime(d[1], "%H:%M").time()).replace(tzinfo=zoneinfo.ZoneInfo(key="Europe/Berlin"))
-                origin = get_station_by_name(session, " ".join(d[2:]))
-                d = l[3].split(",")[0].split(" ")
-                arrivalScheduledTime = datetime.combine(date, datetime.strptime(d[1], "%H:%M").time()).replace(tzinfo=zoneinfo.ZoneInfo(key="Europe/Berlin"))
-                destination = get_station_by_name(session, " ".join(d[2:]))
-                print(origin.name, "to", destination.name)
+        d = l[2].split(",")[0].split(" ")
+        departureScheduledTime = datetime.combine(date, datetime.strptime(d[1], "%H:%M").time()).replace(tzinfo=zoneinfo.ZoneInfo(key="Europe/Berlin"))
+        originName = " ".join(d[2:])
+        d = l[3].split(",")[0].split(" ")
+        arrivalScheduledTime = datetime.combine(date, datetime.strptime(d[1], "%H:%M").time()).replace(tzinfo=zoneinfo.ZoneInfo(key="Europe/Berlin"))
+        destinationName = " ".join(d[2:])
+
+        legs.append((trainName, departureScheduledTime, originName, arrivalScheduledTime, destinationName))
+
+    return date, legs
+
+
+def get_journey_fingerprint(date, legs):
+    # Messages with the same date, trains, times and stations describe the same journey
+    canonical = [date.date().isoformat()] + ["%s|%s|%s|%s|%s" % (" ".join(trainName.split()), departureScheduledTime.isoformat(), normalize_station_name(originName),
+                                                                   arrivalScheduledTime.isoformat(), normalize_station_name(destinationName))
+                                               for trainName, departureScheduledTime, originName, arrivalScheduledTime, destinationName in legs]
+    return hashlib.sha1("\n".join(canonical).encode("utf-8")).hexdigest()
+
+
+async def get_journeys_by_fingerprints(session, fingerprints):
+    # The journeys first saved with or later saved by a message of one of the fingerprints, in a single query
+    if not fingerprints:
+        return {}
+    matches = union_all(select(Journey.id, Journey.fingerprint).where(Journey.fingerprint.in_(fingerprints)),
+                        select(UserJourney.journey_id, UserJourney.fingerprint).where(UserJourney.fingerprint.in_(fingerprints))).subquery()
+    return {fingerprint: journey for journey, fingerprint in await session.execute(select(Journey, matches.c.fingerprint).join(matches, matches.c.id == Journey.id))}
+
+
+async def save_userjourney(session, user, segments, message_id, text, fingerprint=None, journey=None):
+    # Returns the already stored journey of the user instead, if it is a dupe. journey is given if it is known by its fingerprint.
+    if journey is None:
+        journey_id = "#".join([s.segment_id for s in segments])
+        journey = await get_journey_or_create_by_journey_id(session, journey_id, segments)
+    if journey.fingerprint is None:
+        journey.fingerprint = fingerprint
+    userjourney = await get_userjourney_by_user_journey(session, user, journey, message_id, text, fingerprint)
+
+    session.add(userjourney)
+    if userjourney.message_id == message_id:
+        await update_user_statistics(session, userjourney, 1)
+    return journey, userjourney
+
+
+# Dimensions which depend on the price, category or purpose, the others only on the segments
+USERJOURNEY_DIMENSIONS = ("total", "category", "purpose")
+
+
+def get_userjourney_statistics(userjourney, sign=1, dimensions=None):
+    month = parse_journey_message(userjourney.text)[0].date().replace(day=1)
+    statistics = {}
+
+    def add(dimension, key, trips=0, distance=0, duration=0, delay=0, delays=0, price=0):
+        row = statistics.setdefault((dimension, key), {"user_id": userjourney.user_id, "month": month, "dimension": dimension, "key": key,
+                                                       "trips": 0, "distance": 0, "duration": 0, "delay": 0, "delays": 0, "price": 0})
+        row["trips"] += sign * trips
+        row["distance"] += sign * distance
+        row["duration"] += sign * duration
+        row["delay"] += sign * delay
+        row["delays"] += sign * delays
+        row["price"] += sign * price
+
+    totals = {"trips": 1, "distance": 0, "duration": 0, "delay": 0, "delays": 0, "price": userjourney.price or 0}
+    for segment in userjourney.journey.segments:
+        metrics = {"distance": get_segment_distance(segment), "duration": 0, "delay": 0, "delays": 0}
+        if segment.departureScheduledTime is not None and segment.arrivalScheduledTime is not None:
+            metrics["duration"] = int((segment.arrivalScheduledTime - segment.departureScheduledTime).total_seconds())
+        if segment.arrivalDelay is not None:
+            metrics["delay"] = segment.arrivalDelay
+            metrics["delays"] = 1
+        for metric, value in metrics.items():
+            totals[metric] += value
+
+        add("train", segment.trainName or "", trips=1, **metrics)
+        add("station", segment.origin.name or "", trips=1)
+        add("station", segment.destination.name or "", trips=1)
+        for edge in segment.edges:
+            add("edge", str(edge.id), trips=1, distance=edge.distance)
+
+    add("total", "", **totals)
+    if userjourney.category is not None:
+        add("category", userjourney.category.category, **totals)
+    if userjourney.purpose is not None:
+        add("purpose", userjourney.purpose.purpose, **totals)
+
+    return [row for row in statistics.values() if dimensions is None or row["dimension"] in dimensions]
+
+
+async def get_userjourneys_for_statistics(session, *criteria):
+    return (await session.scalars(select(UserJourney)
+                                  .where(*criteria)
+                                  .options(joinedload(UserJourney.category),
+                                           joinedload(UserJourney.purpose),
+                                           selectinload(UserJourney.journey)
+                                           .selectinload(Journey.segments)
+                                           .options(joinedload(Segment.origin), joinedload(Segment.destination), joinedload(Segment.edges)))
+                                  .execution_options(populate_existing=True))).all()
+
+
+def merge_user_statistics(rows):
+    # An upsert must not contain the same row twice
+    merged = {}
+    for row in rows:
+        key = (row["user_id"], row["month"], row["dimension"], row["key"])
+        if key in merged:
+            for metric in ("trips", "distance", "duration", "delay", "delays", "price"):
+                merged[key][metric] += row[metric]
+        else:
+            merged[key] = dict(row)
+    return [merged[key] for key in sorted(merged)]
+
+
+async def add_user_statistics(session, rows):
+    if len(rows) == 0:
+        return
+    statement = insert(UserStatistic).values(merge_user_statistics(rows))
+    await session.execute(statement.on_conflict_do_update(
+        index_elements=[UserStatistic.user_id, UserStatistic.month, UserStatistic.dimension, UserStatistic.key],
+        set_={metric: getattr(UserStatistic, metric) + getattr(statement.excluded, metric)
+              for metric in ("trips", "distance", "duration", "delay", "delays", "price")}))
+
+
+async def update_user_statistics(session, userjourney, sign, dimensions=None):
+    # sign is 1 when a journey is counted and -1 when it is removed, changes are a removal followed by an addition
+    await session.flush()
+    userjourneys = await get_userjourneys_for_statistics(session, UserJourney.user_id == userjourney.user_id, UserJourney.journey_id == userjourney.journey_id)
+    await add_user_statistics(session, [row for userjourney in userjourneys for row in get_userjourney_statistics(userjourney, sign, dimensions)])
+
+
+async def rebuild_user_statistics(session, user):
+    await session.execute(sql_delete(UserStatistic).where(UserStatistic.user_id == user.id))
+    await add_user_statistics(session, [row for userjourney in await get_userjourneys_for_statistics(session, UserJourney.user_id == user.id)
+                                        for row in get_userjourney_statistics(userjourney)])
+
+
+def parse_period(period):
+    # Returns the first month of the period and the first month after it
+    if period is None or period == "all":
+        return None, None
+    if re.fullmatch(r"[0-9]{4}", period):
+        return datetime_date(int(period), 1, 1), datetime_date(int(period) + 1, 1, 1)
+    if re.fullmatch(r"[0-9]{4}-[0-9]{1,2}", period):
+        year, month = map(int, period.split("-"))
+        if not 1 <= month <= 12:
+            raise Exception("Received period in wrong format!")
+        return datetime_date(year, month, 1), datetime_date(year + month // 12, month % 12 + 1, 1)
+    raise Exception("Received period in wrong format! Use all, YYYY or YYYY-MM.")
+
+
+EXPORT_FORMATS = ["csv", "jsonl", "geojson"]
+EXPORT_COLUMNS = ["message_id", "date", "price", "category", "purpose", "leg", "train", "origin", "origin_eva", "departure",
+                  "destination", "destination_eva", "arrival", "distance", "departure_delay", "arrival_delay"]
+
+
+async def stream_userjourneys(session, user, batch_size=500):
+    # Journeys are read with a server side cursor, the relationships of each batch are loaded with a few IN queries
+    result = await session.stream_scalars(select(UserJourney)
+                                          .where(UserJourney.user_id == user.id)
+                                          .order_by(UserJourney.message_id)
+                                          .options(selectinload(UserJourney.category),
+                                                   selectinload(UserJourney.purpose),
+                                                   selectinload(UserJourney.journey)
+                                                   .selectinload(Journey.segments)
+                                                   .options(selectinload(Segment.origin), selectinload(Segment.destination)))
+                                          .execution_options(yield_per=batch_size))
+    async for userjourney in result:
+        yield userjourney
+
+
+def get_export_rows(userjourney):
+    # journey_id keeps the order of the segments of the message
+    order = {segment_id: i for i, segment_id in enumerate((userjourney.journey.journey_id or "").split("#"))}
+    segments = sorted(userjourney.journey.segments, key=lambda segment: order.get(segment.segment_id, len(order)))
+    date = parse_journey_message(userjourney.text)[0].date().isoformat() if userjourney.text else None
+    for i, segment in enumerate(segments):
+        yield {"message_id": userjourney.message_id,
+               "date": date,
+               "price": userjourney.price / 100 if userjourney.price is not None else None,
+               "category": userjourney.category.category if userjourney.category is not None else None,
+               "purpose": userjourney.purpose.purpose if userjourney.purpose is not None else None,
+               "leg": i + 1,
+               "train": segment.trainName,
+               "origin": segment.origin.name,
+               "origin_eva": segment.origin.eva,
+               "departure": segment.departureScheduledTime.isoformat() if segment.departureScheduledTime is not None else None,
+               "destination": segment.destination.name,
+               "destination_eva": segment.destination.eva,
+               "arrival": segment.arrivalScheduledTime.isoformat() if segment.arrivalScheduledTime is not None else None,
+               "distance": round(get_segment_distance(segment)),
+               "departure_delay": segment.departureDelay,
+               "arrival_delay": segment.arrivalDelay,
+               "_coordinates": [[station.longitude, station.latitude] for station in (segment.origin, segment.destination)]}
+
+
+async def write_export(session, user, format, file):
+    if format not in EXPORT_FORMATS:
+        raise Exception("Received export format in wrong format! Use %s." % ", ".join(EXPORT_FORMATS))
+
+    if format == "csv":
+        writer = csv.DictWriter(file, fieldnames=EXPORT_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+    elif format == "geojson":
+        file.write('{"type": "FeatureCollection", "features": [\n')
+
+    count = 0
+    async for userjourney in stream_userjourneys(session, user):
+        rows = list(get_export_rows(userjourney))
+        if format == "csv":
+            writer.writerows(rows)
+        elif format == "jsonl":
+            journey = {column: rows[0][column] for column in EXPORT_COLUMNS[:5]} if rows else {"message_id": userjourney.message_id}
+            journey["legs"] = [{column: row[column] for column in EXPORT_COLUMNS[5:]} for row in rows]
+            file.write(json.dumps(journey, ensure_ascii=False) + "\n")
+        else:
+            for row in rows:
+                feature = {"type": "Feature",
+                           "geometry": {"type": "LineString", "coordinates": row["_coordinates"]},
+                           "properties": {column: row[column] for column in EXPORT_COLUMNS}}
+                file.write((",\n" if count else "") + json.dumps(feature, ensure_ascii=False))
+                count += 1
+
+    if format == "geojson":
+        file.write("\n]}\n")
+
+
+MAP_FORMATS = ["geojson", "svg"]
+
+
+async def get_user_edges(session, user, start=None, end=None):
+    # The travelled network of a user with the number of traversals per edge, aggregated from the statistics
+    station1, station2 = aliased(Station), aliased(Station)
+    traversals = func.sum(UserStatistic.trips)
+    query = (select(Edge.distance, station1, station2, traversals)
+             .select_from(UserStatistic)
+             .join(Edge, Edge.id == cast(UserStatistic.key, Integer))
+             .join(station1, Edge.station1_id == station1.id)
+             .join(station2, Edge.station2_id == station2.id)
+             .where(UserStatistic.user_id == user.id, UserStatistic.dimension == "edge")
+             .group_by(Edge.id, station1.id, station2.id)
+             .having(traversals > 0)
+             .order_by(Edge.id))
+    if start is not None:
+        query = query.where(UserStatistic.month >= start, UserStatistic.month < end)
+    return (await session.execute(query)).all()
+
+
+def write_map(edges, format, file, width=1000, margin=20):
+    if format not in MAP_FORMATS:
+        raise Exception("Received map format in wrong format! Use %s." % ", ".join(MAP_FORMATS))
+
+    if format == "geojson":
+        features = [{"type": "Feature",
+                     "geometry": {"type": "LineString", "coordinates": [[station1.longitude, station1.latitude], [station2.longitude, station2.latitude]]},
+                     "properties": {"from": station1.name, "to": station2.name, "traversals": traversals, "distance": round(distance)}}
+                    for distance, station1, station2, traversals in edges]
+        json.dump({"type": "FeatureCollection", "features": features}, file, ensure_ascii=False)
+        return
+
+    # Equirectangular projection, longitudes are shortened by the cosine of the mean latitude
+    latitudes = np.array([[station1.latitude, station2.latitude] for distance, station1, station2, traversals in edges])
+    longitudes = np.array([[station1.longitude, station2.longitude] for distance, station1, station2, traversals in edges])
+    x = longitudes * math.cos(math.radians(latitudes.mean()))
+    y = -latitudes
+    scale = (width - 2 * margin) / max(np.ptp(x), np.ptp(y), 1e-6)
+    x = (x - x.min()) * scale + margin
+    y = (y - y.min()) * scale + margin
+    strokes = 1 + np.log2([traversals for distance, station1, station2, traversals in edges])
+
+    file.write('<svg xmlns="http://www.w3.org/2000/svg" width="%i" height="%i">\n' % (np.ptp(x) + 2 * margin, np.ptp(y) + 2 * margin))
+    file.write('<rect width="100%" height="100%" fill="white"/>\n<g stroke="#c00000" stroke-linecap="round">\n')
+    for (distance, station1, station2, traversals), (x1, x2), (y1, y2), stroke in zip(edges, x, y, strokes):
+        file.write('<line x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f" stroke-width="%.1f"><title>%s - %s: %i</title></line>\n'
+                   % (x1, y1, x2, y2, stroke, html.escape(station1.name or ""), html.escape(station2.name or ""), traversals))
+    file.write("</g>\n</svg>\n")
+
+
+async def export_to_file(user_id, format, output=None):
+    async with Session() as session:
+        user = (await session.execute(select(User).filter_by(user_id=str(user_id)))).scalar_one_or_none()
+        if user is None:
+            raise Exception("Could not find user %s!" % user_id)
+        if output is None:
+            await write_export(session, user, format, sys.stdout)
+        else:
+            with open(output, "w", newline="", encoding="utf-8") as file:
+                await write_export(session, user, format, file)
+
+
+def split_messages(text):
+    # A text file holds many journey messages, each one starts with a block whose second line is the date
+    messages = []
+    for block in split_on_empty_lines(text):
+        l = split_on_new_lines(block)
+        if len(messages) == 0 or (len(l) >= 2 and re.match("([0-9]+)\.([0-9]+)\.([0-9]+)", l[1])):
+            messages.append([])
+        messages[-1].append(block)
+    return ["\n\n".join(blocks) for blocks in messages]
+
+
+def get_export_messages(data, user_id=None):
+    # Messages of a Telegram chat export (result.json), optionally only those sent by the given user
+    messages = []
+    for message in data.get("messages", []):
+        if message.get("type") != "message":
+            continue
+        if user_id is not None and message.get("from_id") != "user%s" % user_id:
+            continue
+        text = message.get("text", "")
+        if isinstance(text, list):
+            text = "".join(part if isinstance(part, str) else part.get("text", "") for part in text)
+        if text:
+            messages.append((message["id"], text))
+    return messages
+
+
+def get_import_messages(content, user_id=None, next_message_id=-1):
+    # Messages of text files get negative ids, so they never collide with real Telegram messages
+    try:
+        return get_export_messages(json.loads(content), user_id)
+    except ValueError:
+        return [(next_message_id - i, text) for i, text in enumerate(split_messages(content))]
+
+
+async def get_next_import_message_id(session, user):
+    # Below every id imported before, so several text files of a user do not overwrite each other
+    lowest = await session.scalar(select(func.min(UserJourney.message_id)).where(UserJourney.user_id == user.id))
+    return min(lowest or 0, 0) - 1
+
+
+async def run_work_queue(items, worker, concurrency, progress=None):
+    # Results are the return value of the worker or the exception it raised
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+    results = {}
+
+    async def consume():
+        while not queue.empty():
+            item = queue.get_nowait()
+            try:
+                results[item] = await worker(item)
+            except Exception as e:
+                results[item] = e
+            if progress is not None:
+                await progress(len(results), len(items))
+
+    await asyncio.gather(*[consume() for _ in range(concurrency)])
+    return results
+
+
+async def import_messages(session, user, messages, progress=None):
+    imported, dupes, failed = 0, 0, []
+    concurrency = int(os.getenv("HAFAS_MAX_CONCURRENCY", "8"))
+    batch_size = int(os.getenv("IMPORT_BATCH_SIZE", "50"))
+
+    async def report(stage, done, total):
+        if progress is not None:
+            await progress(stage, done, total)
+
+    known = set(await session.scalars(select(UserJourney.message_id).where(UserJourney.user_id == user.id,
+                                                                          UserJourney.message_id.in_([message_id for message_id, text in messages]))))
+    parsed = []
+    for message_id, text in messages:
+        if message_id in known:
+            dupes += 1
+            continue
+        try:
+            date, legs = parse_journey_message(text)
+            parsed.append((message_id, text, legs, get_journey_fingerprint(date, legs)))
+        except Exception as e:
+            failed.append((message_id, e))
+
+    # Messages identical to already saved ones reuse their journeys without any lookup
+    journeys = await get_journeys_by_fingerprints(session, list({fingerprint for message_id, text, legs, fingerprint in parsed}))
+
+    # Every station name and leg is looked up only once for the whole batch
+    names = [name for message_id, text, legs, fingerprint in parsed if fingerprint not in journeys for leg in legs for name in (leg[2], leg[4])]
+    stations = await get_known_stations_by_names(session, names)
+    missing = [name for name in dict.fromkeys(names) if name not in stations]
+    if missing:
+        locations = await run_work_queue(missing, find_location_by_name, concurrency, functools.partial(report, "Resolving stations"))
+        found = {name: location for name, location in locations.items() if not isinstance(location, Exception)}
+        if found:
+            stations.update(await get_or_create_stations_by_names_locations(session, found))
+        await session.commit()
+
+    segments = {}
+    for message_id, text, legs, fingerprint in parsed:
+        if fingerprint in journeys:
+            continue
+        for leg in legs:
+            if leg not in segments and leg[2] in stations and leg[4] in stations:
+                segments[leg] = await get_segment_by_origin_destination_departuretime_arrivaltime(session, stations[leg[2]], stations[leg[4]], leg[1], leg[3], leg[0])
+    missing = [leg for leg, segment in segments.items() if segment is None]
+    if missing:
+        hafasLegs = await run_work_queue(missing, lambda leg: find_leg_by_origin_destination_departuretime_arrivaltime(stations[leg[2]].eva, stations[leg[4]].eva, leg[1], leg[3], leg[0]),
+                                         concurrency, functools.partial(report, "Resolving legs"))
+        found = [hafasLeg for hafasLeg in hafasLegs.values() if not isinstance(hafasLeg, Exception)]
+        if found:
+            legStations, legEdges = await get_or_create_stations_edges_by_legs(session, found)
+            await session.commit()
+        for i, (leg, hafasLeg) in enumerate(sorted(hafasLegs.items(), key=lambda item: "" if isinstance(item[1], Exception) else item[1].id)):
+            if not isinstance(hafasLeg, Exception):
+                segments[leg] = await get_segment_or_create_by_leg(session, hafasLeg, legStations, legEdges)
+            if (i + 1) % batch_size == 0:
+                await session.commit()
+        await session.commit()
+
+    for i, (message_id, text, legs, fingerprint) in enumerate(parsed):
+        unresolved = [leg for leg in legs if segments.get(leg) is None] if fingerprint not in journeys else []
+        if unresolved:
+            failed.append((message_id, Exception("Could not resolve %s from %s to %s" % (unresolved[0][0], unresolved[0][2], unresolved[0][4]))))
+            continue
+        journey, userjourney = await save_userjourney(session, user, [segments.get(leg) for leg in legs], message_id, text, fingerprint, journeys.get(fingerprint))
+        if userjourney.message_id == message_id:
+            imported += 1
+        else:
+            dupes += 1
+        if (i + 1) % batch_size == 0:
+            await session.commit()
+            await report("Saving journeys", i + 1, len(parsed))
+    await session.commit()
+
+    return imported, dupes, failed
+
+
+def format_import_result(imported, dupes, failed):
+    text = "Imported %i journey(s), %i dupe(s), %i failed" % (imported, dupes, len(failed))
+    for message_id, e in failed[:10]:
+        text += "\n%s: %s" % (message_id, e.args[0] if e.args else e)
+    return text
+
+
+async def import_from_file(user_id, path):
+    with open(path, encoding="utf-8") as file:
+        content = file.read()
+    async with Session() as session:
+        user = await get_user_or_create_by_user_id(session, user_id)
+        messages = get_import_messages(content, user_id=user_id, next_message_id=await get_next_import_message_id(session, user))
+
+        async def progress(stage, done, total):
+            print("%s: %i/%i" % (stage, done, total))
+
+        print(format_import_result(*await import_messages(session, user, messages, progress)))
+
+
+async def refresh_delays(hours, batch_size, rate, interval):
+    # Delays are final once the train arrived, so a segment is refreshed until it was refreshed after its arrival.
+    # Segments refreshed during the last half interval are skipped. The batch is claimed before HAFAS is queried,
+    # like the pending journeys, so workers running the job at the same time do not fetch the same segments.
+    now = to_database_time(datetime.now(zoneinfo.ZoneInfo(key="Europe/Berlin")))
+    async with Session() as session:
+        batch = (select(Segment.id)
+                 .where(Segment.departureScheduledTime.between(now - timedelta(hours=hours), now),
+                        or_(Segment.delayUpdatedTime.is_(None),
+                            (Segment.delayUpdatedTime < func.coalesce(Segment.arrivalTime, Segment.arrivalScheduledTime))
+                            & (Segment.delayUpdatedTime < now - timedelta(seconds=interval / 2))),
+                        or_(Segment.delayLockedUntil.is_(None), Segment.delayLockedUntil < func.now()))
+                 .order_by(Segment.departureScheduledTime)
+                 .limit(batch_size)
+                 .with_for_update(skip_locked=True))
+        # The lease covers fetching the whole batch at the given rate, a crashed worker's batch is claimed again afterwards
+        claimed = (await session.scalars(sql_update(Segment)
+                                         .where(Segment.id.in_(batch.scalar_subquery()))
+                                         .values(delayLockedUntil=func.now() + timedelta(seconds=max(interval, 2 * batch_size / rate)))
+                                         .returning(Segment.id))).all()
+        # The connection is not needed while HAFAS is queried
+        await session.commit()
+        if not claimed:
+            return 0, 0
+        segments = (await session.scalars(select(Segment)
+                                          .where(Segment.id.in_(claimed))
+                                          .order_by(Segment.departureScheduledTime)
+                                          .options(joinedload(Segment.origin), joinedload(Segment.destination)))).all()
+        await session.commit()
+
+        bucket = TokenBucket(rate, burst=max(1, int(rate)))
+
+        async def fetch(segment):
+            await bucket.acquire()
+            return await hafas.trip(segment.segment_id, refresh=True)
+
+        legs = await asyncio.gather(*[fetch(segment) for segment in segments], return_exceptions=True)
+        rows = []
+        changed = []
+        for segment, leg in zip(segments, legs):
+            if isinstance(leg, Exception):
+                print("Could not refresh delays of %s. e.args: %s" % (segment.segment_id, leg.args))
+                DELAY_REFRESHES.labels("failed").inc()
+                continue
+            delays = get_segment_delays(segment, leg)
+            if delays is None:
+                print("Trip of %s does not pass its origin and destination" % segment.segment_id)
+                DELAY_REFRESHES.labels("failed").inc()
+                continue
+            rows.append({"id": segment.id, "delayUpdatedTime": now, "delayLockedUntil": None, **delays})
+            if any(getattr(segment, column) != value for column, value in delays.items()):
+                changed.append(segment.id)
+                DELAY_REFRESHES.labels("changed").inc()
+            else:
+                DELAY_REFRESHES.labels("unchanged").inc()
+        # Segments which failed are released, so the next refresh tries them again
+        failed = set(claimed) - {row["id"] for row in rows}
+        if failed:
+            await session.execute(sql_update(Segment).where(Segment.id.in_(failed)).values(delayLockedUntil=None))
+        if not rows:
+            await session.commit()
+            return 0, 0
+
+        # The statistics of the affected journeys are removed with the old delays and added with the new ones
+        affected = UserJourney.journey_id.in_(select(JourneySegment.journey_id).where(JourneySegment.segment_id.in_(changed)))
+        statistics = [row for userjourney in await get_userjourneys_for_statistics(session, affected) for row in get_userjourney_statistics(userjourney, -1)] if changed else []
+        await session.execute(sql_update(Segment), rows)
+        if changed:
+            statistics += [row for userjourney in await get_userjourneys_for_statistics(session, affected) for row in get_userjourney_statistics(userjourney)]
+        await add_user_statistics(session, statistics)
+        await session.commit()
+        return len(rows), len(changed)
+
+
+async def refreshDelays(context: ContextTypes.DEFAULT_TYPE):
+    with span("delays"):
+        refreshed, changed = await refresh_delays(hours=int(os.getenv("DELAY_REFRESH_HOURS", "12")),
+                                                  batch_size=int(os.getenv("DELAY_REFRESH_BATCH_SIZE", "200")),
+                                                  rate=float(os.getenv("DELAY_REFRESH_RATE", "2")),
+                                                  interval=int(os.getenv("DELAY_REFRESH_INTERVAL", "900")))
+    if refreshed:
+        print("Refreshed delays of %i segments, %i changed" % (refreshed, changed))
+
+
+async def backfill_edges(batch_size=500):
+    # Segments stored before edges existed get them from their stopovers, afterwards the statistics of all users are rebuilt
+    last_id, backfilled = 0, 0
+    async with Session() as session:
+        while True:
+            segments = (await session.scalars(select(Segment)
+                                              .where(Segment.id > last_id, ~select(SegmentEdge).where(SegmentEdge.segment_id == Segment.id).exists())
+                                              .order_by(Segment.id)
+                                              .limit(batch_size)
+                                              .options(joinedload(Segment.origin), joinedload(Segment.destination)))).all()
+            if not segments:
+                break
+            last_id = segments[-1].id
+
+            stopovers = {}
+            for stopover, station in await session.execute(select(Stopover, Station).join(Station, Stopover.station_id == Station.id)
+                                                           .where(Stopover.segment_id.in_([segment.id for segment in segments]))):
+                stopovers.setdefault(stopover.segment_id, []).append((stopover.sequence, station))
+            routes = {segment.id: get_segment_route(segment, stopovers.get(segment.id, [])) for segment in segments}
+
+            edges = await get_or_create_edges(session, list(routes.values()))
+            rows = sorted({(segment_id, edges[get_edge_key(a, b)].id) for segment_id, route in routes.items() for a, b in get_route_pairs(route)})
+            if rows:
+                await session.execute(insert(SegmentEdge)
+                                      .values([{"segment_id": segment_id, "edge_id": edge_id} for segment_id, edge_id in rows])
+                                      .on_conflict_do_nothing())
+            await session.commit()
+            backfilled += len(segments)
+            print("Backfilled edges of %i segments" % backfilled)
+
+        for user in (await session.scalars(select(User).order_by(User.id))).all():
+            await rebuild_user_statistics(session, user)
+            await session.commit()
+        print("Rebuilt statistics of all users")
+
+
+async def get_segments_by_legs(session, legs):
+    with span("stations"):
+        stations = await get_stations_by_names(session, [name for leg in legs for name in (leg[2], leg[4])])
+    evas = {name: station.eva for name, station in stations.items()}
+    for trainName, departureScheduledTime, originName, arrivalScheduledTime, destinationName in legs:
+        print(stations[originName].name, "to", stations[destinationName].name)
+
+    with span("segments.lookup"):
+        segments = [await get_segment_by_origin_destination_departuretime_arrivaltime(session, stations[originName], stations[destinationName], departureScheduledTime, arrivalScheduledTime, trainName)
+                    for trainName, departureScheduledTime, originName, arrivalScheduledTime, destinationName in legs]
+        missing = [i for i, segment in enumerate(segments) if segment is None]
+        # Stations are shared by all messages, they are committed on their own so concurrent messages do not wait
+        # for each other. This also returns the connection to the pool while HAFAS is queried.
+        await session.commit()
+
+    # All unknown legs are looked up at once, the results keep the order of the message
+    with span("legs"):
+        hafasLegs = await gather_or_cancel(*[
+            find_leg_by_origin_destination_departuretime_arrivaltime(evas[legs[i][2]], evas[legs[i][4]], legs[i][1], legs[i][3], legs[i][0])
+            for i in missing])
+
+    with span("segments.create"):
+        if hafasLegs:
+            stations, edges = await get_or_create_stations_edges_by_legs(session, hafasLegs)
+            await session.commit()
+
+        # Segments are created in the same order by every message, so concurrent messages with shared legs cannot deadlock
+        for i, leg in sorted(zip(missing, hafasLegs), key=lambda item: item[1].id):
+            segments[i] = await get_segment_or_create_by_leg(session, leg, stations, edges)
+
+    return segments
+
+
+async def save_journey_message(session, user_id, message_id, text):
+    date, legs = parse_journey_message(text)
+    fingerprint = get_journey_fingerprint(date, legs)
+
+    # Forwarded or repeated messages are answered without looking up any station or leg
+    with span("fingerprint"):
+        journey = (await get_journeys_by_fingerprints(session, [fingerprint])).get(fingerprint)
+    segments = await get_segments_by_legs(session, legs) if journey is None else None
+
+    with span("save"):
+        user = await get_user_or_create_by_user_id(session, user_id)
+        journey, userjourney = await save_userjourney(session, user, segments, message_id, text, fingerprint, journey)
+        await session.commit()
+    return journey, userjourney
+
+
+async def reply_saved_journey(message, journey, userjourney):
+    if userjourney.message_id == message.id:
+        print("Saved Journey %i to database" % journey.id)
+        await message.reply_text("\u2705 Saved in database!", reply_to_message_id=message.id)
+    else:
+        print("Duped Journey %i" % journey.id)
+        await message.reply_text("\uE252 Duped Journey. Original Journey", reply_to_message_id=userjourney.message_id)
+        await message.reply_text("\uE252 Ignored.", reply_to_message_id=message.id)
+
+
+async def update_journey_message(session, user, userjourney, text):
+    # Legs which are the same as in the stored text keep their segments, only changed legs are looked up again.
+    # Returns the number of legs looked up and the journey the message is a dupe of, if it became one.
+    date, legs = parse_journey_message(text)
+    fingerprint = get_journey_fingerprint(date, legs)
+    oldLegs = parse_journey_message(userjourney.text)[1]
+    order = {segment_id: i for i, segment_id in enumerate(userjourney.journey.journey_id.split("#"))}
+    oldSegments = sorted(userjourney.journey.segments, key=lambda segment: order.get(segment.segment_id, len(order)))
+    known = dict(zip(oldLegs, oldSegments)) if len(oldLegs) == len(oldSegments) else {}
+
+    segments = [known.get(leg) for leg in legs]
+    changed = [i for i, segment in enumerate(segments) if segment is None]
+    if changed:
+        for i, segment in zip(changed, await get_segments_by_legs(session, [legs[i] for i in changed])):
+            segments[i] = segment
+
+    await update_user_statistics(session, userjourney, -1)
+    journey_id = "#".join([segment.segment_id for segment in segments])
+    if journey_id != userjourney.journey.journey_id:
+        journey = await get_journey_or_create_by_journey_id(session, journey_id, segments)
+        if journey.fingerprint is None:
+            journey.fingerprint = fingerprint
+        original = (await session.execute(select(UserJourney).filter_by(user_id=user.id, journey_id=journey.id))).scalar_one_or_none()
+        if original is not None:
+            # The message now describes a journey the user saved with another message
+            await session.delete(userjourney)
+            return len(changed), original
+        userjourney.journey = journey
+    userjourney.text = text
+    userjourney.fingerprint = fingerprint
+    await update_user_statistics(session, userjourney, 1)
+    return len(changed), None
+
+
+async def defer_journey_message(user_id, chat_id, message_id, text):
+    async with Session() as session:
+        # A message edited while it is pending is saved with its latest text
+        statement = insert(PendingJourney).values(user_id=user_id, chat_id=chat_id, message_id=message_id, text=text)
+        await session.execute(statement.on_conflict_do_update(index_elements=[PendingJourney.user_id, PendingJourney.message_id],
+                                                              set_={"text": statement.excluded.text}))
+        await session.commit()
+
+
+async def claim_pending_journey(session, lease):
+    head = (select(PendingJourney.user_id, PendingJourney.message_id)
+            .where(or_(PendingJourney.locked_until.is_(None), PendingJourney.locked_until < func.now()))
+            .order_by(PendingJourney.created)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .subquery())
+    claimed = (await session.execute(sql_update(PendingJourney)
+                                     .where(PendingJourney.user_id == head.c.user_id, PendingJourney.message_id == head.c.message_id)
+                                     .values(locked_until=func.now() + timedelta(seconds=lease))
+                                     .returning(PendingJourney.user_id, PendingJourney.chat_id, PendingJourney.message_id, PendingJourney.text))).first()
+    await session.commit()
+    return claimed
+
+
+async def finish_pending_journey(user_id, message_id, saved):
+    # Messages which could not be saved yet are released for the next retry
+    async with Session() as session:
+        statement = sql_delete(PendingJourney) if saved else sql_update(PendingJourney).values(locked_until=None)
+        await session.execute(statement.where(PendingJourney.user_id == user_id, PendingJourney.message_id == message_id))
+        await session.commit()
+
+
+async def retry_pending_journeys(bot, batch_size, lease):
+    handled = 0
+    while handled < batch_size and not hafas.breaker.is_open():
+        async with Session() as session:
+            claimed = await claim_pending_journey(session, lease)
+        if claimed is None:
+            break
+
+        user_id, chat_id, message_id, text = claimed
+        # Replies go to the original message, like the ones of toDatabase
+        message = Message(message_id, datetime.now(), Chat(chat_id, Chat.PRIVATE))
+        message.set_bot(bot)
+        async with Session() as session:
+            try:
+                journey, userjourney = await save_journey_message(session, user_id, message_id, text)
+                await reply_saved_journey(message, journey, userjourney)
+            except HafasUnavailableError as e:
+                print("Could not save pending message yet. e.args: %s" % e.args)
+                await session.rollback()
+                await finish_pending_journey(user_id, message_id, False)
+                break
+            except Exception as e:
+                print("Could not fetch pending message. e.args: %s" % e.args)
+                await message.reply_text("\uE333 Could not fetch this message! e.args: %s" % e.args, reply_to_message_id=message_id)
+                await session.rollback()
+        await finish_pending_journey(user_id, message_id, True)
+        handled += 1
+    return handled
+
+
+async def retryPendingJourneys(context: ContextTypes.DEFAULT_TYPE):
+    handled = await retry_pending_journeys(context.bot, batch_size=int(os.getenv("PENDING_RETRY_BATCH_SIZE", "50")), lease=int(os.getenv("QUEUE_LEASE", "60")))
+    if handled:
+        print("Handled %i pending messages" % handled)
+
+
+@traced
+async def editJourney(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    print("Triggered editJourney command by %i" % update.effective_user.id)
+    message = update.edited_message
+    userjourney = None
+    async with Session() as session:
+        try:
+            user = await get_user_or_create_by_user_id(session, update.effective_user.id)
+            userjourney = (await session.execute(select(UserJourney).filter_by(user=user, message_id=message.id)
+                                                 .options(selectinload(UserJourney.journey).selectinload(Journey.segments)))).scalar_one_or_none()
+            if userjourney is None:
+                # The message was not saved before, for example because it could not be fetched
+                journey, userjourney = await save_journey_message(session, update.effective_user.id, message.id, message.text)
+                await finish_pending_journey(update.effective_user.id, message.id, True)
+                await reply_saved_journey(message, journey, userjourney)
+            elif userjourney.text == message.text:
+                await message.reply_text("\u2705 Journey did not change!", reply_to_message_id=message.id)
+            else:
+                lookedUp, original = await update_journey_message(session, user, userjourney, message.text)
+                await session.commit()
+                if original is not None:
+                    print("Edited Journey is a dupe of message %i" % original.message_id)
+                    await message.reply_text("\uE252 Duped Journey. Original Journey", reply_to_message_id=original.message_id)
+                    await message.reply_text("\uE252 Removed.", reply_to_message_id=message.id)
+                else:
+                    print("Updated Journey %i, looked up %i leg(s)" % (userjourney.journey.id, lookedUp))
+                    await message.reply_text("\u2705 Updated in database!", reply_to_message_id=message.id)
+        except HafasUnavailableError as e:
+            await session.rollback()
+            if userjourney is not None:
+                # The saved journey stays as it is, the edit can be repeated later
+                print("Could not update journey. e.args: %s" % e.args)
+                await message.reply_text("\uE333 Could not update this journey! e.args: %s" % e.args, reply_to_message_id=message.id)
+            else:
+                await defer_journey_message(update.effective_user.id, update.effective_chat.id, message.id, message.text)
+                print("Deferred message. e.args: %s" % e.args)
+                await message.reply_text("\u23F8 HAFAS is unavailable at the moment, the journey will be saved as soon as it is back.", reply_to_message_id=message.id)
+        except Exception as e:
+            print("Could not update journey. e.args: %s" % e.args)
+            await message.reply_text("\uE333 Could not update this journey! e.args: %s" % e.args, reply_to_message_id=message.id)
+            await session.rollback()
+        else:
+            await session.commit()
 
-                segments.append(get_segment_or_create_by_origin_destination_departuretime_arrivaltime(session, origin, destination, departureScheduledTime, arrivalScheduledTime, trainName))
 
-            journey_id = "#".join([s.segment_id for s in segments])
-            user = get_user_or_create_by_user_id(session, update.effective_user.id)
-            journey = get_journey_or_create_by_journey_id(session, journey_id, segments)
-            userjourney = get_userjourney_by_user_journey(session, user, journey, update.message.id, update.message.text)
+@traced
+async def toDatabase(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.user_data.get("import") is not None:
+        # The user collects messages for a bulk import
+        context.user_data["import"].append((update.message.id, update.message.text))
+        return
 
-            session.add(userjourney)
-            session.commit()
-            if userjourney.message_id == update.message.id:
-                print("Saved Journey %i to database" % journey.id)
-                await update.message.reply_text("\u2705 Saved in database!", reply_to_message_id=update.message.id)
-            else:
-                print("Duped Journey %i" % journey.id)
-                await update.message.reply_text("\uE252 Duped Journey. Original Journey", reply_to_message_id=userjourney.message_id)
-                await update.message.reply_text("\uE252 Ignored.", reply_to_message_id=update.message.id)
+    print("Triggered toDatabase command by %i" % update.effective_user.id)
+    loading_message = await update.message.reply_text("\u23F3 Loading...", reply_to_message_id=update.message.id)
+    input = update.message.text
+    async with Session() as session:
+        try:
+            journey, userjourney = await save_journey_message(session, update.effective_user.id, update.message.id, input)
+            await reply_saved_journey(update.message, journey, userjourney)
+        except HafasUnavailableError as e:
+            await session.rollback()
+            await defer_journey_message(update.effective_user.id, update.effective_chat.id, update.message.id, input)
+            print("Deferred message. e.args: %s" % e.args)
+            await update.message.reply_text("\u23F8 HAFAS is unavailable at the moment, the journey will be saved as soon as it is back.", reply_to_message_id=update.message.id)
         except Exception as e:
             print("Could not fetch message. e.args: %s" % e.args)
             await update.message.reply_text("\uE333 Could not fetch this message! e.args: %s" % e.args, reply_to_message_id=update.message.id)
-            session.rollback()
+            await session.rollback()
         else:
-            session.commit()
+            await session.commit()
 
 
+@traced
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     print("Triggered start command by %i" % update.effective_user.id)
     await context.bot.send_message(
@@ -342,74 +1998,81 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@traced
 async def delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with Session() as session:
+    async with Session() as session:
         try:
-            instance = session.query(UserJourney).filter_by(
-                user=get_user_or_create_by_user_id(session, user_id=update.effective_user.id),
-                message_id=update.message.reply_to_message.id).one_or_none()
+            instance = (await session.execute(select(UserJourney).filter_by(
+                user=await get_user_or_create_by_user_id(session, user_id=update.effective_user.id),
+                message_id=update.message.reply_to_message.id))).scalar_one_or_none()
 
             if instance is None:
                 raise Exception("Couldnt find journey! Maybe its deleted or a dupe.")
 
-            instance.delete()
-            session.commit()
+            await update_user_statistics(session, instance, -1)
+            await session.delete(instance)
+            await session.commit()
             print("Deleted journey")
             await update.message.reply_text("\u2705 Deleted journey", reply_to_message_id=update.message.id)
         except Exception as e:
             print("Deletion failed! e.args: %s" % e.args)
             await update.message.reply_text("\uE333 Setting price failed! e.args: %s" % e.args,
                                             reply_to_message_id=update.message.id)
-            session.rollback()
+            await session.rollback()
         else:
-            session.commit()
+            await session.commit()
 
 
+@traced
 async def price(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with Session() as session:
+    async with Session() as session:
         try:
             if len(context.args) < 0 or len(context.args) > 1:
                 raise Exception("Received too less or too much arguments!")
 
             price = context.args[0]
 
-            instance = session.query(UserJourney).filter_by(user=get_user_or_create_by_user_id(session, user_id=update.effective_user.id), message_id=update.message.reply_to_message.id).one_or_none()
+            instance = (await session.execute(select(UserJourney).filter_by(user=await get_user_or_create_by_user_id(session, user_id=update.effective_user.id), message_id=update.message.reply_to_message.id))).scalar_one_or_none()
 
             if instance is None:
                 raise Exception("Couldnt find journey! Maybe its deleted or a dupe.")
 
+            await update_user_statistics(session, instance, -1, USERJOURNEY_DIMENSIONS)
             if price == "None":
                 instance.price = None
             else:
                 price = price.replace(",", ".")
                 if not price.replace(".", "").isdigit():
                    raise Exception("Received price in wrong format!")
-                instance.price = float(price) * 100
+                instance.price = round(float(price) * 100)
             session.add(instance)
-            session.commit()
+            await update_user_statistics(session, instance, 1, USERJOURNEY_DIMENSIONS)
+            await session.commit()
             print("Price set to %s" % price)
             await update.message.reply_text("\u2705 Price set to %s" % price, reply_to_message_id=update.message.id)
         except Exception as e:
             print("Setting price failed! e.args: %s" % e.args)
             await update.message.reply_text("\uE333 Setting price failed! e.args: %s" % e.args, reply_to_message_id=update.message.id)
-            session.rollback()
+            await session.rollback()
         else:
-            session.commit()
+            await session.commit()
 
 
+@traced
 async def category(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with Session() as session:
+    async with Session() as session:
         try:
             if len(context.args) < 0 or len(context.args) > 2:
                 raise Exception("Received too less or too much arguments!")
 
             category = context.args[0]
 
-            instance = session.query(UserJourney).filter_by(user=get_user_or_create_by_user_id(session, user_id=update.effective_user.id), message_id=update.message.reply_to_message.id).one_or_none()
+            instance = (await session.execute(select(UserJourney).filter_by(user=await get_user_or_create_by_user_id(session, user_id=update.effective_user.id), message_id=update.message.reply_to_message.id))).scalar_one_or_none()
 
             if instance is None:
                 raise Exception("Couldnt find journey! Maybe its deleted or a dupe.")
 
+            await update_user_statistics(session, instance, -1, USERJOURNEY_DIMENSIONS)
             category = category.lower()
             if category == "none":
                 instance.category = None
@@ -418,34 +2081,37 @@ async def category(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     color = context.args[1]
                     if not re.fullmatch(r'^#(?:[0-9a-fA-F]{3}){1,2}$', color):
                         raise Exception("Received color in wrong format!")
-                    instance.category = get_category_or_create_by_category(session, category, color)
+                    instance.category = await get_category_or_create_by_category(session, category, color)
                 else:
-                    instance.category = get_category_or_create_by_category(session, category)
+                    instance.category = await get_category_or_create_by_category(session, category)
             session.add(instance)
-            session.commit()
+            await update_user_statistics(session, instance, 1, USERJOURNEY_DIMENSIONS)
+            await session.commit()
             print("Category set to %s" % category)
             await update.message.reply_text("\u2705 Category set to %s" % category, reply_to_message_id=update.message.id)
         except Exception as e:
             print("Setting category failed! e.args: %s" % e.args)
             await update.message.reply_text("\uE333 Setting category failed! e.args: %s" % e.args, reply_to_message_id=update.message.id)
-            session.rollback()
+            await session.rollback()
         else:
-            session.commit()
+            await session.commit()
 
 
+@traced
 async def purpose(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with Session() as session:
+    async with Session() as session:
         try:
             if len(context.args) < 0 or len(context.args) > 2:
                 raise Exception("Received too less or too much arguments!")
 
             purpose = context.args[0]
 
-            instance = session.query(UserJourney).filter_by(user=get_user_or_create_by_user_id(session, user_id=update.effective_user.id), message_id=update.message.reply_to_message.id).one_or_none()
+            instance = (await session.execute(select(UserJourney).filter_by(user=await get_user_or_create_by_user_id(session, user_id=update.effective_user.id), message_id=update.message.reply_to_message.id))).scalar_one_or_none()
 
             if instance is None:
                 raise Exception("\uE333 Could not find journey! Maybe its deleted or a dupe.")
 
+            await update_user_statistics(session, instance, -1, USERJOURNEY_DIMENSIONS)
             purpose = purpose.lower()
             if purpose == "none":
                 instance.purpose = None
@@ -454,62 +2120,468 @@ async def purpose(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     color = context.args[1]
                     if not re.fullmatch(r'^#(?:[0-9a-fA-F]{3}){1,2}$', color):
                         raise Exception("Received color in wrong format!")
-                    instance.purpose = get_purpose_or_create_by_purpose(session, purpose, color)
+                    instance.purpose = await get_purpose_or_create_by_purpose(session, purpose, color)
                 else:
-                    instance.purpose = get_purpose_or_create_by_purpose(session, purpose)
+                    instance.purpose = await get_purpose_or_create_by_purpose(session, purpose)
             session.add(instance)
-            session.commit()
+            await update_user_statistics(session, instance, 1, USERJOURNEY_DIMENSIONS)
+            await session.commit()
             print("Purpose set to %s" % purpose)
             await update.message.reply_text("\u2705 Purpose set to %s" % purpose, reply_to_message_id=update.message.id)
         except Exception as e:
             print("Setting purpose failed! e.args: %s" % e.args)
             await update.message.reply_text("\uE333 Setting purpose failed! e.args: %s" % e.args, reply_to_message_id=update.message.id)
-            session.rollback()
+            await session.rollback()
         else:
-            session.commit()
+            await session.commit()
 
 
+@traced
 async def username(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with Session() as session:
+    async with Session() as session:
         try:
             if len(context.args) < 0 or len(context.args) > 1:
                 raise Exception("Received too less or too much arguments!")
 
             username = context.args[0]
 
-            instance = session.query(User).filter_by(username=username).one_or_none()
+            instance = (await session.execute(select(User).filter_by(username=username))).scalar_one_or_none()
 
             if instance is not None:
                 raise Exception("Username already in use!")
 
-            instance = get_user_or_create_by_user_id(session, user_id=update.effective_user.id)
+            instance = await get_user_or_create_by_user_id(session, user_id=update.effective_user.id)
 
             if username == "None":
                 raise Exception("Username is invalid!")
             else:
                 instance.username = username
             session.add(instance)
-            session.commit()
+            await session.commit()
             print("Username set to %s" % username)
             await update.message.reply_text("\u2705 Username set to %s" % username, reply_to_message_id=update.message.id)
         except Exception as e:
             print("Setting username failed! e.args: %s" % e.args)
             await update.message.reply_text("\uE333 Setting username failed! e.args: %s" % e.args, reply_to_message_id=update.message.id)
-            session.rollback()
+            await session.rollback()
         else:
-            session.commit()
+            await session.commit()
 
 
-if __name__ == "__main__":
-    Base.metadata.create_all(engine)
+def format_duration(seconds):
+    return "%i h %02i min" % (seconds // 3600, seconds % 3600 // 60)
 
-    print("Starting Telegram Bot...")
+
+def format_ranking(rows, value, limit=5):
+    rows = sorted([row for row in rows if value(row)], key=value, reverse=True)[:limit]
+    return ", ".join("%s (%s)" % (row["key"] or "?", value(row) if isinstance(value(row), int) else "%.2f" % value(row)) for row in rows) or "-"
+
+
+# Column summed over the total statistics of a user and how it is shown
+LEADERBOARD_METRICS = {
+    "distance": (UserStatistic.distance, lambda value: "%.0f km" % (value / 1000)),
+    "trips": (UserStatistic.trips, lambda value: "%i" % value),
+    "delay": (UserStatistic.delay, lambda value: "%.0f min" % (value / 60)),
+    "spend": (UserStatistic.price, lambda value: "%.2f \u20AC" % (value / 100)),
+}
+
+
+async def get_leaderboard(session, metric, period):
+    # Users only take part once they have set a username, until then it is their Telegram user id
+    start, end = parse_period(period)
+    ranking = leaderboard_cache.get((metric, start, end))
+    if ranking is not None:
+        return ranking
+
+    value = func.sum(LEADERBOARD_METRICS[metric][0])
+    query = (select(User.user_id, User.username, value)
+             .join(UserStatistic, UserStatistic.user_id == User.id)
+             .where(UserStatistic.dimension == "total", User.username != User.user_id)
+             .group_by(User.id)
+             .having(value > 0)
+             .order_by(value.desc(), User.username))
+    if start is not None:
+        query = query.where(UserStatistic.month >= start, UserStatistic.month < end)
+    ranking = (await session.execute(query)).all()
+    leaderboard_cache.put((metric, start, end), ranking)
+    return ranking
+
+
+@traced
+async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async with Session() as session:
+        try:
+            if len(context.args) > 2:
+                raise Exception("Received too less or too much arguments!")
+
+            metric = context.args[0].lower() if len(context.args) > 0 else "distance"
+            period = context.args[1] if len(context.args) > 1 else "all"
+            if metric not in LEADERBOARD_METRICS:
+                raise Exception("Received metric in wrong format! Use %s." % ", ".join(LEADERBOARD_METRICS))
+
+            ranking = await get_leaderboard(session, metric, period)
+            limit = int(os.getenv("LEADERBOARD_SIZE", "10"))
+            format_value = LEADERBOARD_METRICS[metric][1]
+            lines = ["\U0001F3C6 Leaderboard by %s (%s)" % (metric, period)]
+            lines += ["%i. %s: %s" % (rank, username, format_value(value)) for rank, (user_id, username, value) in enumerate(ranking[:limit], 1)]
+            # Users further down still see where they are
+            lines += ["...\n%i. %s: %s" % (rank, username, format_value(value)) for rank, (user_id, username, value) in enumerate(ranking, 1)
+                      if rank > limit and user_id == str(update.effective_user.id)]
+            if not ranking:
+                lines.append("Nobody yet, only users who set a /username take part")
+            print("Sent leaderboard by %s for %s" % (metric, period))
+            await update.message.reply_text("\n".join(lines), reply_to_message_id=update.message.id)
+        except Exception as e:
+            print("Fetching leaderboard failed! e.args: %s" % e.args)
+            await update.message.reply_text("\uE333 Fetching leaderboard failed! e.args: %s" % e.args, reply_to_message_id=update.message.id)
+            await session.rollback()
+        else:
+            await session.commit()
+
+
+@traced
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async with Session() as session:
+        try:
+            if len(context.args) > 1:
+                raise Exception("Received too less or too much arguments!")
+
+            period = context.args[0] if len(context.args) == 1 else "all"
+            user = await get_user_or_create_by_user_id(session, user_id=update.effective_user.id)
+
+            if period == "rebuild":
+                await rebuild_user_statistics(session, user)
+                await session.commit()
+                period = "all"
+
+            start, end = parse_period(period)
+            # Edges are only needed by /map and would be the most rows by far
+            query = select(UserStatistic).where(UserStatistic.user_id == user.id, UserStatistic.dimension != "edge")
+            if start is not None:
+                query = query.where(UserStatistic.month >= start, UserStatistic.month < end)
+
+            rows = {}
+            for statistic in await session.scalars(query):
+                row = rows.setdefault((statistic.dimension, statistic.key), {"dimension": statistic.dimension, "key": statistic.key,
+                                                                             "trips": 0, "distance": 0, "duration": 0, "delay": 0, "delays": 0, "price": 0})
+                for metric in ("trips", "distance", "duration", "delay", "delays", "price"):
+                    row[metric] += getattr(statistic, metric)
+
+            total = rows.get(("total", ""), {"trips": 0, "distance": 0, "duration": 0, "delay": 0, "delays": 0, "price": 0})
+            dimension = lambda name: [row for row in rows.values() if row["dimension"] == name]
+            text = "\n".join([
+                "\U0001F4CA Statistics (%s)" % period,
+                "Trips: %i" % total["trips"],
+                "Distance: %.0f km" % (total["distance"] / 1000),
+                "Time on train: %s" % format_duration(total["duration"]),
+                "Average delay: %s" % ("%.1f min" % (total["delay"] / total["delays"] / 60) if total["delays"] else "-"),
+                "Spend: %.2f \u20AC" % (total["price"] / 100),
+                "Spend per category: %s" % format_ranking(dimension("category"), lambda row: row["price"] / 100, limit=10),
+                "Spend per purpose: %s" % format_ranking(dimension("purpose"), lambda row: row["price"] / 100, limit=10),
+                "Top stations: %s" % format_ranking(dimension("station"), lambda row: row["trips"]),
+                "Top trains: %s" % format_ranking(dimension("train"), lambda row: row["trips"]),
+            ])
+            print("Sent statistics for %s" % period)
+            await update.message.reply_text(text, reply_to_message_id=update.message.id)
+        except Exception as e:
+            print("Fetching statistics failed! e.args: %s" % e.args)
+            await update.message.reply_text("\uE333 Fetching statistics failed! e.args: %s" % e.args, reply_to_message_id=update.message.id)
+            await session.rollback()
+        else:
+            await session.commit()
+
+
+@traced
+async def showMap(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async with Session() as session:
+        try:
+            if len(context.args) > 2:
+                raise Exception("Received too less or too much arguments!")
+
+            format = next((arg.lower() for arg in context.args if arg.lower() in MAP_FORMATS), "geojson")
+            period = next((arg for arg in context.args if arg.lower() not in MAP_FORMATS), "all")
+            user = await get_user_or_create_by_user_id(session, user_id=update.effective_user.id)
+
+            start, end = parse_period(period)
+            edges = await get_user_edges(session, user, start, end)
+            if not edges:
+                raise Exception("No travelled routes in this period!")
+
+            distances = np.array([distance for distance, station1, station2, traversals in edges])
+            traversals = np.array([traversals for distance, station1, station2, traversals in edges])
+            caption = "\U0001F5FA Network (%s): %.0f km of track, %.0f km travelled" % (period, distances.sum() / 1000, (distances * traversals).sum() / 1000)
+
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "map.%s" % format)
+                with open(path, "w", encoding="utf-8") as file:
+                    write_map(edges, format, file)
+                with open(path, "rb") as file:
+                    await update.message.reply_document(document=file, caption=caption, reply_to_message_id=update.message.id)
+            print("Sent map of %i edges for %s" % (len(edges), period))
+        except Exception as e:
+            print("Rendering map failed! e.args: %s" % e.args)
+            await update.message.reply_text("\uE333 Rendering map failed! e.args: %s" % e.args, reply_to_message_id=update.message.id)
+            await session.rollback()
+        else:
+            await session.commit()
+
+
+@traced
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async with Session() as session:
+        try:
+            if len(context.args) > 1:
+                raise Exception("Received too less or too much arguments!")
+
+            format = context.args[0].lower() if len(context.args) == 1 else "csv"
+            user = await get_user_or_create_by_user_id(session, user_id=update.effective_user.id)
+
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "journeys.%s" % format)
+                with open(path, "w", newline="", encoding="utf-8") as file:
+                    await write_export(session, user, format, file)
+                with open(path, "rb") as file:
+                    await update.message.reply_document(document=file, reply_to_message_id=update.message.id)
+            print("Exported journeys as %s" % format)
+        except Exception as e:
+            print("Export failed! e.args: %s" % e.args)
+            await update.message.reply_text("\uE333 Export failed! e.args: %s" % e.args, reply_to_message_id=update.message.id)
+            await session.rollback()
+        else:
+            await session.commit()
+
+
+async def run_import(update, context, messages):
+    progress_message = await update.message.reply_text("\u23F3 Importing %i message(s)..." % len(messages), reply_to_message_id=update.message.id)
+    last_edit = [0]
+
+    async def progress(stage, done, total):
+        # Telegram limits message edits, so the progress is updated at most every few seconds
+        if time.monotonic() - last_edit[0] < 3 and done < total:
+            return
+        last_edit[0] = time.monotonic()
+        try:
+            await progress_message.edit_text("\u23F3 %s: %i/%i" % (stage, done, total))
+        except Exception as e:
+            print("Could not update progress. e.args: %s" % e.args)
+
+    async with Session() as session:
+        try:
+            user = await get_user_or_create_by_user_id(session, user_id=update.effective_user.id)
+            result = await import_messages(session, user, messages, progress)
+            print(format_import_result(*result))
+            await progress_message.edit_text("\u2705 %s" % format_import_result(*result))
+        except Exception as e:
+            print("Import failed! e.args: %s" % e.args)
+            await progress_message.edit_text("\uE333 Import failed! e.args: %s" % e.args)
+            await session.rollback()
+        else:
+            await session.commit()
+
+
+@traced
+async def bulkImport(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    action = context.args[0].lower() if len(context.args) > 0 else "start"
+    if action == "start":
+        context.user_data["import"] = []
+        await update.message.reply_text("\u2705 Send or forward your journeys, then finish with /import done or abort with /import cancel.", reply_to_message_id=update.message.id)
+    elif context.user_data.get("import") is None:
+        await update.message.reply_text("\uE333 No import running! Start one with /import.", reply_to_message_id=update.message.id)
+    elif action == "cancel":
+        context.user_data.pop("import")
+        await update.message.reply_text("\u2705 Import cancelled", reply_to_message_id=update.message.id)
+    elif action == "done":
+        await run_import(update, context, sorted(context.user_data.pop("import")))
+    else:
+        await update.message.reply_text("\uE333 Usage: /import [start|done|cancel]", reply_to_message_id=update.message.id)
+
+
+@traced
+async def importDocument(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        file = await update.message.document.get_file()
+        content = (await file.download_as_bytearray()).decode("utf-8")
+        async with Session() as session:
+            user = await get_user_or_create_by_user_id(session, user_id=update.effective_user.id)
+            next_message_id = await get_next_import_message_id(session, user)
+            await session.commit()
+        messages = get_import_messages(content, user_id=update.effective_user.id, next_message_id=next_message_id)
+    except Exception as e:
+        print("Reading import file failed! e.args: %s" % e.args)
+        await update.message.reply_text("\uE333 Reading import file failed! e.args: %s" % e.args, reply_to_message_id=update.message.id)
+        return
+    await run_import(update, context, messages)
+
+
+@traced
+async def stationcache(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async with Session() as session:
+        try:
+            if str(update.effective_user.id) not in ADMIN_USER_IDS:
+                raise Exception("Only admins may manage the station cache!")
+
+            if len(context.args) == 0 or context.args[0] == "stats":
+                text = "Station cache: %s, %i stored names, index: %s" % (station_name_cache.stats(), await session.scalar(select(func.count()).select_from(StationName)), station_index.stats())
+            elif context.args[0] == "invalidate" and len(context.args) > 1:
+                name = normalize_station_name(" ".join(context.args[1:]))
+                station_name_cache.invalidate(name)
+                count = (await session.execute(sql_delete(StationName).where(StationName.name == name))).rowcount
+                text = "Invalidated %i station name(s)" % count
+            elif context.args[0] in ("block", "unblock") and len(context.args) > 1:
+                # A blocked name is not matched in the station index anymore, the next message resolves it at HAFAS
+                name = " ".join(context.args[1:])
+                key = get_station_index_key(name)
+                if context.args[0] == "block":
+                    await session.execute(insert(BlockedStationName).values(key=key).on_conflict_do_nothing())
+                    station_name_cache.invalidate(normalize_station_name(name))
+                    await session.execute(sql_delete(StationName).where(StationName.name == normalize_station_name(name)))
+                    text = "Blocked %s in the station index" % key
+                else:
+                    await session.execute(sql_delete(BlockedStationName).where(BlockedStationName.key == key))
+                    text = "Unblocked %s in the station index" % key
+            elif context.args[0] == "clear":
+                station_name_cache.clear()
+                count = (await session.execute(sql_delete(StationName))).rowcount
+                text = "Cleared %i station name(s)" % count
+            else:
+                raise Exception("Usage: /stationcache [stats|invalidate <name>|block <name>|unblock <name>|clear]")
+            await session.commit()
+            print(text)
+            await update.message.reply_text("\u2705 %s" % text, reply_to_message_id=update.message.id)
+        except Exception as e:
+            print("Managing station cache failed! e.args: %s" % e.args)
+            await update.message.reply_text("\uE333 Managing station cache failed! e.args: %s" % e.args, reply_to_message_id=update.message.id)
+            await session.rollback()
+        else:
+            await session.commit()
+
+
+async def enqueue_update(update):
+    user = update.effective_user or update.effective_chat
+    async with Session() as session:
+        # Telegram delivers an update again if it was not acknowledged, it is queued only once
+        await session.execute(insert(QueuedUpdate)
+                              .values(id=update.update_id, key=user.id if user is not None else None, data=json.dumps(update.to_dict()))
+                              .on_conflict_do_nothing(index_elements=[QueuedUpdate.id]))
+        await session.commit()
+
+
+async def claim_update(session, lease):
+    # The oldest update that is neither leased by a worker nor waiting for an earlier update of the same user.
+    # SKIP LOCKED lets workers claim concurrently without waiting for each other.
+    candidate = aliased(QueuedUpdate)
+    earlier = aliased(QueuedUpdate)
+    head = (select(candidate.id)
+            .where(or_(candidate.locked_until.is_(None), candidate.locked_until < func.now()),
+                   ~select(earlier.id).where(earlier.key == candidate.key, earlier.id < candidate.id).exists())
+            .order_by(candidate.id)
+            .limit(1)
+            .with_for_update(skip_locked=True))
+    claimed = (await session.execute(sql_update(QueuedUpdate)
+                                     .where(QueuedUpdate.id == head.scalar_subquery())
+                                     .values(locked_until=func.now() + timedelta(seconds=lease), attempts=QueuedUpdate.attempts + 1)
+                                     .returning(QueuedUpdate.id, QueuedUpdate.data, QueuedUpdate.attempts, func.now() - QueuedUpdate.created))).first()
+    await session.commit()
+    return claimed
+
+
+async def extend_lease(update_id, lease):
+    # The lease expires if the worker dies, then the update is handled by another worker
+    while True:
+        await asyncio.sleep(lease / 3)
+        async with Session() as session:
+            await session.execute(sql_update(QueuedUpdate).where(QueuedUpdate.id == update_id).values(locked_until=func.now() + timedelta(seconds=lease)))
+            await session.commit()
+
+
+async def finish_update(update_id):
+    async with Session() as session:
+        await session.execute(sql_delete(QueuedUpdate).where(QueuedUpdate.id == update_id))
+        await session.commit()
+
+
+async def run_worker(application, poll_interval, lease, max_attempts):
+    while True:
+        async with Session() as session:
+            claimed = await claim_update(session, lease)
+        if claimed is None:
+            await asyncio.sleep(poll_interval)
+            continue
+
+        update_id, data, attempts, waited = claimed
+        QUEUE_WAIT_SECONDS.observe(waited.total_seconds())
+        if attempts > max_attempts:
+            print("Dropping update %i after %i attempts" % (update_id, attempts - 1))
+            await finish_update(update_id)
+            continue
+
+        lease_task = asyncio.ensure_future(extend_lease(update_id, lease))
+        try:
+            await application.process_update(Update.de_json(json.loads(data), application.bot))
+            await application.update_persistence()
+        except Exception as e:
+            # The update stays leased and is tried again once the lease expired
+            print("Could not handle update %i. e.args: %s" % (update_id, e.args))
+            continue
+        finally:
+            lease_task.cancel()
+        await finish_update(update_id)
+
+
+async def run_workers(concurrency):
+    application = build_application(persistence=DatabasePersistence())
+    async with application:
+        # Starts the job queue, updates are not fetched by the application itself
+        await application.start()
+        print("Starting %i workers..." % concurrency)
+        await asyncio.gather(*[run_worker(application,
+                                          poll_interval=float(os.getenv("QUEUE_POLL_INTERVAL", "0.5")),
+                                          lease=int(os.getenv("QUEUE_LEASE", "60")),
+                                          max_attempts=int(os.getenv("QUEUE_MAX_ATTEMPTS", "3")))
+                               for _ in range(concurrency)])
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, bot, secret_token):
+        self.bot = bot
+        self.secret_token = secret_token
+
+    async def post(self):
+        if self.secret_token and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret_token:
+            raise tornado.web.HTTPError(403)
+        # Telegram gets its answer only once the update is stored, so no update is lost
+        await enqueue_update(Update.de_json(json.loads(self.request.body), self.bot))
+        QUEUED_UPDATES.inc()
+
+
+async def run_webhook():
+    if not os.getenv("WEBHOOK_URL"):
+        raise Exception("WEBHOOK_URL is required for the webhook mode!")
+    bot = get_application_builder().build().bot
+    async with bot:
+        await bot.set_webhook(os.getenv("WEBHOOK_URL"), secret_token=os.getenv("WEBHOOK_SECRET"), allowed_updates=Update.ALL_TYPES)
+        webhook = tornado.web.Application([(os.getenv("WEBHOOK_PATH", "/telegram"), WebhookHandler, {"bot": bot, "secret_token": os.getenv("WEBHOOK_SECRET")})])
+        webhook.listen(int(os.getenv("WEBHOOK_PORT", "8443")), address=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"))
+        print("Receiving updates for %s..." % os.getenv("WEBHOOK_URL"))
+        await asyncio.Event().wait()
+
+
+def get_application_builder():
     applicationBuilder = ApplicationBuilder().token(os.getenv("TELEGRAM_TOKEN"))
 
     if os.getenv("HTTP_PROXY", None):
         applicationBuilder.proxy_url(os.getenv("HTTP_PROXY"))
         applicationBuilder.get_updates_proxy_url(os.getenv("HTTP_PROXY"))
 
+    return applicationBuilder
+
+
+def build_application(persistence=None):
+    # Handlers do not block on database or HAFAS I/O, so updates are processed concurrently, one at a time per user
+    applicationBuilder = get_application_builder().concurrent_updates(True)
+    if persistence is not None:
+        applicationBuilder.persistence(persistence)
+
     application = applicationBuilder.build()
 
     #await application.bot.set_my_commands([
@@ -519,6 +2591,12 @@ if __name__ == "__main__":
     #    BotCommand("category", "Sets the category of a journey, by replying to it with this command"),
     #    BotCommand("purpose", "Sets the purpose of a journey, by replying to it with this command"),
     #    BotCommand("username", "Sets your username"),
+    #    BotCommand("stats", "Shows your statistics for all, a year (YYYY) or a month (YYYY-MM)"),
+    #    BotCommand("leaderboard", "Ranks all users with a username by distance, trips, delay or spend"),
+    #    BotCommand("map", "Shows your travelled network of all, a year or a month as geojson or svg"),
+    #    BotCommand("export", "Exports your journeys as csv, jsonl or geojson"),
+    #    BotCommand("import", "Imports many journeys at once, finish with /import done"),
+    #    BotCommand("stationcache", "Shows, invalidates or blocks station names (admins only)"),
     #])
 
     print("Creating handler")
@@ -528,7 +2606,15 @@ if __name__ == "__main__":
     category_handler = CommandHandler('category', category)
     purpose_handler = CommandHandler('purpose', purpose)
     username_handler = CommandHandler('username', username)
-    toDatabase_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), toDatabase)
+    stats_handler = CommandHandler('stats', stats)
+    leaderboard_handler = CommandHandler('leaderboard', leaderboard)
+    stationcache_handler = CommandHandler('stationcache', stationcache)
+    map_handler = CommandHandler('map', showMap)
+    export_handler = CommandHandler('export', export)
+    import_handler = CommandHandler('import', bulkImport)
+    importDocument_handler = MessageHandler(filters.UpdateType.MESSAGE & (filters.Document.FileExtension("json") | filters.Document.FileExtension("txt")), importDocument)
+    toDatabase_handler = MessageHandler(filters.UpdateType.MESSAGE & filters.TEXT & (~filters.COMMAND), toDatabase)
+    editJourney_handler = MessageHandler(filters.UpdateType.EDITED_MESSAGE & filters.TEXT & (~filters.COMMAND), editJourney)
 
     print("Adding handler")
     application.add_handler(start_handler)
@@ -537,7 +2623,66 @@ if __name__ == "__main__":
     application.add_handler(category_handler)
     application.add_handler(purpose_handler)
     application.add_handler(username_handler)
+    application.add_handler(stats_handler)
+    application.add_handler(leaderboard_handler)
+    application.add_handler(stationcache_handler)
+    application.add_handler(map_handler)
+    application.add_handler(export_handler)
+    application.add_handler(import_handler)
+    application.add_handler(importDocument_handler)
     application.add_handler(toDatabase_handler)
+    application.add_handler(editJourney_handler)
 
-    application.run_polling()
+    if int(os.getenv("DELAY_REFRESH_INTERVAL", "900")) > 0:
+        print("Scheduling delay refresh")
+        application.job_queue.run_repeating(refreshDelays, interval=int(os.getenv("DELAY_REFRESH_INTERVAL", "900")), first=60)
+    if int(os.getenv("PENDING_RETRY_INTERVAL", "60")) > 0:
+        print("Scheduling retries of pending messages")
+        application.job_queue.run_repeating(retryPendingJourneys, interval=int(os.getenv("PENDING_RETRY_INTERVAL", "60")), first=10)
 
+    return application
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Railway History Telegram Bot")
+    subparsers = parser.add_subparsers(dest="command")
+    export_parser = subparsers.add_parser("export", help="Export the journey history of a user")
+    export_parser.add_argument("user_id", help="Telegram user id")
+    export_parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    export_parser.add_argument("--output", help="Output file, defaults to stdout")
+    import_parser = subparsers.add_parser("import", help="Import journey messages of a Telegram chat export or a text file")
+    import_parser.add_argument("user_id", help="Telegram user id")
+    import_parser.add_argument("file", help="result.json of a chat export or a text file of messages")
+    subparsers.add_parser("refresh-delays", help="Refresh the delays of the recently travelled segments once")
+    subparsers.add_parser("backfill-edges", help="Create the edges of segments stored before they existed and rebuild all statistics")
+    subparsers.add_parser("webhook", help="Receive updates by webhook and queue them for the workers")
+    worker_parser = subparsers.add_parser("worker", help="Handle the updates queued by the webhook")
+    worker_parser.add_argument("--concurrency", type=int, default=int(os.getenv("WORKER_CONCURRENCY", "8")), help="Updates handled at once")
+    args = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(migrate(engine))
+    # Only the commands which resolve station names need the index, export writes its data to stdout
+    if args.command in ("import", "worker", None):
+        asyncio.get_event_loop().run_until_complete(load_station_index())
+
+    if args.command == "export":
+        asyncio.get_event_loop().run_until_complete(export_to_file(args.user_id, args.format, args.output))
+    elif args.command == "import":
+        asyncio.get_event_loop().run_until_complete(import_from_file(args.user_id, args.file))
+    elif args.command == "refresh-delays":
+        asyncio.get_event_loop().run_until_complete(refreshDelays(None))
+    elif args.command == "backfill-edges":
+        asyncio.get_event_loop().run_until_complete(backfill_edges())
+    else:
+        if os.getenv("METRICS_PORT"):
+            # Prometheus metrics are served from a background thread
+            start_http_server(int(os.getenv("METRICS_PORT")), addr=os.getenv("METRICS_ADDR", "127.0.0.1"))
+            print("Serving metrics on %s:%s/metrics" % (os.getenv("METRICS_ADDR", "127.0.0.1"), os.getenv("METRICS_PORT")))
+        if args.command == "webhook":
+            asyncio.get_event_loop().run_until_complete(run_webhook())
+        elif args.command == "worker":
+            asyncio.get_event_loop().run_until_complete(run_workers(args.concurrency))
+        else:
+            print("Starting Telegram Bot...")
+            build_application().run_polling()
@@ -0,0 +1,54 @@
+import asyncio
+from collections import namedtuple
+
+import pytest
+
+import main
+from main import StationIndex
+
+Row = namedtuple("Row", ["id", "eva", "name", "latitude", "longitude"])
+
+
+@pytest.fixture
+def index():
+    index = StationIndex()
+    for i, name in enumerate(["Essenbach", "Hammelburg", "Berlin Ostkreuz", "Berlin Westkreuz", "Frankfurt (Main) Hauptbahnhof", "München Hbf"]):
+        index.add(Row(i, 8000000 + i, name, 0.0, 0.0))
+    return index
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("Berlin Ostkreuz", "Berlin Ostkreuz"),
+    ("  berlin   OSTKREUZ ", "Berlin Ostkreuz"),
+    ("Frankfurt(M) Hbf", "Frankfurt (Main) Hauptbahnhof"),
+    ("Muenchen Hauptbahnhof", "München Hbf"),
+])
+def test_find_exact_names(index, name, expected):
+    assert index.find(name).name == expected
+
+
+@pytest.mark.parametrize("name", ["Essen", "Hamm", "Berlin Ost", "Berlin O", "Berlin Westkreutz", "Berlin", "", "-"])
+def test_find_does_not_guess(index, name):
+    assert index.find(name) is None
+
+
+def test_add_keeps_first_station_of_a_name(index):
+    index.add(Row(100, 8000100, "Berlin-Ostkreuz", 0.0, 0.0))
+    assert index.find("Berlin Ostkreuz").id == 2
+    assert len(index) == 7
+
+
+def test_user_lock_keeps_order_per_user():
+    handled = []
+
+    async def handle(user_id, name, seconds):
+        async with main.user_lock(user_id):
+            await asyncio.sleep(seconds)
+            handled.append(name)
+
+    async def run():
+        await asyncio.gather(handle(1, "journey", 0.05), handle(1, "price", 0), handle(2, "other", 0))
+
+    asyncio.run(run())
+    assert handled == ["other", "journey", "price"]
+    assert main.user_locks == {}